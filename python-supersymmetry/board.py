@@ -1,9 +1,20 @@
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+from itertools import repeat
+
 import numpy as np
 
 from coordinate_transformer import CoordinateTransformer
-import plotlib
+
+
+# Unit steps along the three axes of the board
+DIRECTIONS = (
+    (+1, +0, +1),
+    (+0, +1, +1),
+    (+1, -1, +0),
+    (-1, +0, -1),
+    (+0, -1, -1),
+    (-1, +1, +0),
+)
+
 
 class Board():
     def __init__(self, n=4, colors = ("red", "yellow", "green", "black", "blue", "grey")):
@@ -43,6 +54,16 @@ class Board():
             colors[4]: lambda vec: - vec[0] - vec[1] + vec[2],
         }
 
+        # The coefficients of the progress functions, for evaluating many spots at once
+        self.progress_vectors = {
+            colors[0]: np.array([-1, +1, -1]),
+            colors[1]: np.array([-1, -1, -1]),
+            colors[2]: np.array([+1, -1, -1]),
+            colors[3]: np.array([+1, -1, +1]),
+            colors[5]: np.array([+1, +1, +1]),
+            colors[4]: np.array([-1, -1, +1]),
+        }
+
         # Mapping from color to the color of the opposing player.
         self.opposing = {
             colors[0]: colors[3],
@@ -52,22 +73,73 @@ class Board():
         for a, b in self.opposing.copy().items():
             self.opposing[b] = a
         
-        # All vectors that may possibly be on the board
-        hex_vectors = self.hexgrid()
-        
-        # All vectors in the central field
-        self.field_spots = list(map(tuple, filter(self.in_field, hex_vectors)))
-        
-        # All vectors in each home
-        self.color_spots = {
-            color: list(map(tuple, filter(func, hex_vectors)))
-            for color, func in self.colors.items()
-        }
+        # All vectors in the central field, and in each home. The vectors that may possibly be on the board
+        # are generated one at a time, so that only the spots of the star are kept.
+        self.field_spots = []
+        self.color_spots = { color: [] for color in self.colors }
+        for vec in self.hexgrid():
+            if self.in_field(vec):
+                self.field_spots.append(vec)
+                continue
+            for color, func in self.colors.items():
+                if func(vec):
+                    self.color_spots[color].append(vec)
+                    break
         
         # All vectors in 
         self.board_spots = self.field_spots.copy()
         for spots in self.color_spots.values():
             self.board_spots.extend(spots)
+
+        # Index of every spot in board_spots, so that spots can be looked up in arrays
+        self.spot_index = { spot: i for i, spot in enumerate(self.board_spots) }
+        self.spot_array = np.array(self.board_spots)
+
+        # Index of the neighbours of every spot in each direction, or -1 if there is no neighbour,
+        # as a nested list for walking along the six rays from a spot one neighbour at a time
+        self.neighbour_table = [
+            [self.spot_index.get(tuple(xi + di for xi, di in zip(spot, direction)), -1) for direction in DIRECTIONS]
+            for spot in self.board_spots
+        ]
+        self._neighbours = None
+
+        # The lines of spots along the first three directions, in order, and for every spot
+        # the (line, position in the line) of each of the three lines it is on
+        self.lines = []
+        self.line_positions = [[] for _ in self.board_spots]
+        for direction in range(3):
+            for start, neighbours in enumerate(self.neighbour_table):
+                # Lines start at the spots without a neighbour in the opposite direction
+                if neighbours[direction + 3] >= 0:
+                    continue
+                line = []
+                i = start
+                while i >= 0:
+                    self.line_positions[i].append((len(self.lines), len(line)))
+                    line.append(i)
+                    i = self.neighbour_table[i][direction]
+                self.lines.append(line)
+
+        # Index in DIRECTIONS of every unit step
+        self.direction_index = { direction: i for i, direction in enumerate(DIRECTIONS) }
+
+        # Mapping from spot to the color whose home it is in, for the spots that are in a home
+        self.home_of = { spot: color for color, spots in self.color_spots.items() for spot in spots }
+
+        # Mapping from color to whether each spot is in its home
+        self.home_masks = {}
+        for color, spots in self.color_spots.items():
+            mask = np.zeros(len(self.board_spots), dtype=bool)
+            mask[[self.spot_index[spot] for spot in spots]] = True
+            self.home_masks[color] = mask
+
+    @property
+    def neighbours(self):
+        """The neighbour table as an array, for looking up the neighbours of many spots at once.
+        It is only built when it is first needed."""
+        if self._neighbours is None:
+            self._neighbours = np.array(self.neighbour_table)
+        return self._neighbours
     
     def in_board(self, vec):
         """Returns whether the vector is inside of the board"""
@@ -83,47 +155,10 @@ class Board():
         return (abs(vec[0]) + abs(vec[1]) + abs(vec[2])) <= 2 * self.n
     
     def hexgrid(self):
-        """Returns a list of vectors that may or may not be inside of the board."""
+        """Yields the vectors that may or may not be inside of the board."""
         n = self.n * 2
-        vectors = []
         for u in range(-n, n+1):
-            us = [u] * (2*n+1)
             if u < 0:
-                vectors.extend(zip(us, range(-n-u, n+1), range(-n, n+u+1)))
+                yield from zip(repeat(u), range(-n-u, n+1), range(-n, n+u+1))
             else:
-                vectors.extend(zip(us, range(-n, n-u+1), range(-n+u, n+1)))
-        return vectors
-
-
-class BoardPlotter(object):
-    def __init__(self, board, transformer):
-        self.board = board
-        self.transformer = transformer
-    
-    def plot_transformed(self, in_vectors, newfig=True, text=False, **kwargs):
-        mpl.style.use("default")
-        if newfig:
-            plt.figure(figsize=(7, 7))
-        
-        transformed = self.transformer(np.array(in_vectors))
-        
-        if text:
-            for (xh, yh, zh), (x, y) in zip(in_vectors, transformed):
-                plt.text(x, y, "[{},{},{}]".format(xh, yh, zh), fontsize=7)
-        
-        if len(transformed) > 0:
-            alpha = kwargs.pop('alpha', 0.3)
-            plt.scatter(*transformed.T, alpha=alpha, **kwargs)
-        plotlib.geom_plot(xticks=[], yticks=[], xlabel="", ylabel="")
-    
-    def plot_spots(self, text=False, **kwargs):
-        newfig = kwargs.pop('newfig', False)
-        self.show_spots(self.board.field_spots, newfig=newfig, color="lightgreen", text=text, **kwargs)
-        for color, spots in self.board.color_spots.items():
-            self.show_spots(spots, newfig=False, color=color, text=text, **kwargs)
-    
-    def plot_move(self, vec_in, vec_out, curved=True, **kwargs):
-        plotlib.arrow(self.transformer(vec_in), self.transformer(vec_out), curved, **kwargs)
-    
-    def show_spots(self, spots, **kwargs):
-        self.plot_transformed(spots, **kwargs)
+                yield from zip(repeat(u), range(-n, n-u+1), range(-n+u, n+1))
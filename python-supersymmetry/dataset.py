@@ -0,0 +1,217 @@
+"""Training data for learned evaluators: one record per play of a simulation, in memory-mapped chunks.
+Export the plays of a run with python simulate.py config.json --dataset data/
+"""
+from bisect import bisect_right
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+from hooks import GameHooks
+from results import GrowableArray, match_score
+from state import GameState
+
+
+FORMAT_VERSION = 1
+
+
+def record_dtype(n_planes, n_spots):
+    """The dtype of a record for games with n_planes colors on a board with n_spots spots"""
+    return np.dtype([
+        ('game', '<u8'),
+        ('ply', '<u4'),
+        ('to_move', 'u1'),
+        ('start', '<i2'),
+        ('end', '<i2'),
+        ('n_moves', '<u2'),
+        ('outcome', '<f4'),
+        ('planes', 'u1', (n_planes, (n_spots + 7) // 8)),
+    ])
+
+
+def encode_planes(cells, to_move, n_planes):
+    """Packs GameState cells into occupancy planes, starting with the color to move"""
+    cells = np.frombuffer(cells, dtype=np.uint8)
+    colors = (to_move + np.arange(n_planes)) % n_planes + 1
+    return np.packbits(cells == colors[:, None], axis=1)
+
+
+def write_json(path, data):
+    """Writes the JSON to a temporary file first, so that the file is never half written"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class DatasetExportHooks(GameHooks):
+    """Exports every play of the games to the dataset at path, in a background thread; call close at the end"""
+    def __init__(self, path, chunk_size=1 << 20, max_pending=2):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.meta = None
+        self.game_id = -1
+        self.buffer = None
+        self.records = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.writer = None
+        self.error = None
+        os.makedirs(path, exist_ok=True)
+
+    def start(self, game):
+        colors = list(game.player_spots)
+        n_spots = len(game.board.board_spots)
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            # Append to the dataset that is already there, e.g. when a run is resumed from a checkpoint
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            if self.meta['format'] != FORMAT_VERSION or self.meta['n'] != game.board.n or self.meta['colors'] != colors:
+                raise ValueError("The dataset in {} is for games of another size or with other colors".format(self.path))
+        else:
+            self.meta = {
+                'format': FORMAT_VERSION,
+                'n': game.board.n,
+                'colors': colors,
+                'n_spots': n_spots,
+                'chunk_size': self.chunk_size,
+                'chunks': [],
+                'records': 0,
+            }
+        self.dtype = record_dtype(len(colors), n_spots)
+        self.buffer = GrowableArray(self.dtype, min(self.chunk_size, 1024))
+        self.records = GrowableArray(self.dtype, 256)
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def before_game(self, game):
+        if self.meta is None:
+            self.start(game)
+        elif list(game.player_spots) != self.meta['colors'] or game.board.n != self.meta['n']:
+            raise ValueError("Every game in a dataset must have the same board size and colors")
+        self.game = game
+        # Games played by a Simulator are recorded under their id in the simulation
+        self.game_id = game.game_id if game.game_id is not None else self.game_id + 1
+        self.colors = list(game.player_spots)
+        self.plays = dict.fromkeys(self.colors, 0)
+        self.finished = {}
+        self.records.clear()
+
+    def before_play(self, color, player):
+        state = GameState.from_game(self.game, color)
+        self.planes = encode_planes(state.cells, state.to_move, len(self.colors))
+
+    def after_play(self, color, player, moves):
+        spot_index = self.game.board.spot_index
+        self.records.append((
+            self.game_id, self.game.plies - 1, self.colors.index(color),
+            spot_index[moves[0]], spot_index[moves[-1]], len(moves) - 1, 0.0, self.planes,
+        ))
+        self.plays[color] += 1
+
+        # The round in which the color finished, like in the win sequence
+        if self.game.win_condition(color):
+            self.finished[color] = self.plays[color] - 1
+
+    def after_game(self):
+        # The colors that did not finish come after all the colors that did
+        rounds = max(self.plays.values())
+        win_sequence = [(color, self.finished.get(color, rounds)) for color in self.colors]
+        records = self.records.data
+        outcomes = np.array([match_score(win_sequence, color) for color in self.colors], dtype=np.float32)
+        records['outcome'] = outcomes[records['to_move']]
+
+        self.buffer.extend(records)
+        while len(self.buffer) >= self.chunk_size:
+            self.put_chunk(self.buffer.data[:self.chunk_size].copy())
+            rest = self.buffer.data[self.chunk_size:].copy()
+            self.buffer.clear()
+            self.buffer.extend(rest)
+
+    def put_chunk(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(chunk)
+
+    def write_chunks(self):
+        """Writes the chunks from the queue, and the meta data after each of them. Runs in the writer thread."""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            try:
+                filename = "chunk-{:06d}.npy".format(len(self.meta['chunks']))
+                np.save(os.path.join(self.path, filename), chunk)
+                self.meta['chunks'].append({ 'file': filename, 'records': len(chunk) })
+                self.meta['records'] += len(chunk)
+                write_json(os.path.join(self.path, "meta.json"), self.meta)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        """Writes the records that are left, and waits for the writer to finish"""
+        if self.writer is None:
+            return
+        if len(self.buffer):
+            self.put_chunk(self.buffer.data.copy())
+            self.buffer.clear()
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        if self.error is not None:
+            raise self.error
+
+
+class Dataset(object):
+    """A dataset written by DatasetExportHooks, indexed by an int, a slice or an array of indices"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.colors = self.meta['colors']
+        self.n_spots = self.meta['n_spots']
+        self.dtype = record_dtype(len(self.colors), self.n_spots)
+        self.chunks = [
+            np.load(os.path.join(path, chunk['file']), mmap_mode='r')
+            for chunk in self.meta['chunks']
+        ]
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in self.chunks])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Record {} is out of range".format(index))
+            chunk = bisect_right(self.offsets, index) - 1
+            return self.chunks[chunk][index - self.offsets[chunk]]
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        index = np.asarray(index, dtype=np.int64)
+        index = np.where(index < 0, index + len(self), index)
+        if np.any((index < 0) | (index >= len(self))):
+            raise IndexError("Records out of range")
+
+        # Gather the records chunk by chunk
+        records = np.empty(len(index), dtype=self.dtype)
+        chunks = np.searchsorted(self.offsets, index, side='right') - 1
+        for chunk in np.unique(chunks):
+            selected = chunks == chunk
+            records[selected] = self.chunks[chunk][index[selected] - self.offsets[chunk]]
+        return records
+
+    def planes(self, records):
+        """Unpacks the occupancy planes of records to a (records, colors, spots) array of booleans"""
+        return np.unpackbits(records['planes'], axis=-1, count=self.n_spots).astype(bool)
+
+    def sample(self, size, rng=None):
+        """Returns size records drawn at random (with replacement)"""
+        rng = rng if rng is not None else np.random.default_rng()
+        return self[rng.integers(len(self), size=size)]
@@ -0,0 +1,212 @@
+"""Plays the games of a Simulator on worker processes on any number of machines.
+Start workers with SUPERSYMMETRY_AUTHKEY=secret python distributed.py host:port, and the coordinator with simulate.py --listen host:port.
+"""
+import argparse
+from collections import deque
+from multiprocessing.connection import Client, Listener
+from multiprocessing import AuthenticationError
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+
+def authkey_from_env():
+    key = os.environ.get('SUPERSYMMETRY_AUTHKEY')
+    return key.encode() if key else None
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class Coordinator(object):
+    """Hands out shards of the games of a simulator to the workers that connect to the address with the authkey"""
+    def __init__(self, simulator, address=('localhost', 0), authkey=None, shard_size=16, shard_timeout=None):
+        self.simulator = simulator
+        self.authkey = authkey if authkey else os.urandom(16)
+        self.shard_size = shard_size
+        self.shard_timeout = shard_timeout
+        self.listener = Listener(address, authkey=self.authkey)
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.pending = {}
+        self.finished = {}
+        self.done = True
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def run(self, n_sims, progress=None):
+        """Plays n_sims games on the workers and adds them to the simulator's results"""
+        t0 = time.perf_counter()
+        simulator = self.simulator
+
+        # A seed drawn for the run is only given to the workers, and the simulator keeps the one it was given
+        self.worker_simulator = simulator.worker_copy()
+        if self.worker_simulator.seed is None:
+            self.worker_simulator.seed = random.randrange(2**32)
+
+        game_ids = range(simulator.results.n_games, simulator.results.n_games + n_sims)
+        with self.condition:
+            self.done = False
+            self.finished = {}
+            self.pending = {}
+            self.queue = deque(
+                tuple(game_ids[i:i + self.shard_size])
+                for i in range(0, len(game_ids), self.shard_size)
+            )
+        acceptor = threading.Thread(target=self.accept, daemon=True)
+        acceptor.start()
+
+        reported = 0
+        with self.condition:
+            while len(self.finished) < n_sims:
+                self.condition.wait(timeout=1.0)
+                self.requeue_late_shards()
+                if progress and len(self.finished) > reported:
+                    reported = len(self.finished)
+                    progress(reported, time.perf_counter() - t0)
+            self.done = True
+            self.condition.notify_all()
+
+        # Wake the acceptor up so that it sees that the run is done
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+        acceptor.join()
+
+        for game_id in game_ids:
+            simulator.results.add_game(self.finished[game_id], game_id)
+
+    def close(self):
+        self.listener.close()
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # A client that failed to authenticate, or that disconnected right away
+                connection = None
+            with self.condition:
+                if self.done:
+                    if connection is not None:
+                        connection.close()
+                    return
+            if connection is not None:
+                threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def requeue_late_shards(self):
+        if self.shard_timeout is None:
+            return
+        now = time.perf_counter()
+        for shard, started in list(self.pending.items()):
+            if now - started > self.shard_timeout:
+                del self.pending[shard]
+                self.queue.append(shard)
+                self.condition.notify_all()
+
+    def next_shard(self):
+        """Waits for a shard with games that are not finished yet, or returns None when the run is done"""
+        with self.condition:
+            while not self.done:
+                while self.queue:
+                    shard = self.queue.popleft()
+                    if any(game_id not in self.finished for game_id in shard):
+                        self.pending[shard] = time.perf_counter()
+                        return shard
+                self.condition.wait()
+            return None
+
+    def record(self, game_id, win_sequence, profile):
+        with self.condition:
+            # A shard that was handed out again can be played twice, but the result is the same
+            if game_id in self.finished:
+                return
+            self.finished[game_id] = win_sequence
+            if profile is not None:
+                self.simulator.profiler.merge(profile)
+            self.condition.notify_all()
+
+    def serve(self, connection):
+        shard = None
+        try:
+            connection.send(('simulator', self.worker_simulator))
+            while True:
+                shard = self.next_shard()
+                if shard is None:
+                    connection.send(('stop',))
+                    return
+                connection.send(('shard', shard))
+                while True:
+                    message = connection.recv()
+                    if message[0] == 'game':
+                        self.record(*message[1:])
+                    else:
+                        break
+                with self.condition:
+                    self.pending.pop(shard, None)
+                shard = None
+        except (OSError, EOFError):
+            # The worker is gone, so let another worker play the rest of its shard
+            if shard is not None:
+                with self.condition:
+                    self.pending.pop(shard, None)
+                    self.queue.append(shard)
+                    self.condition.notify_all()
+        finally:
+            connection.close()
+
+
+def run_worker(address, authkey):
+    """Plays the shards the coordinator at the address hands out, until it says stop or goes away"""
+    connection = Client(address, authkey=authkey)
+    try:
+        _, simulator = connection.recv()
+        while True:
+            message = connection.recv()
+            if message[0] == 'stop':
+                return
+            for game_id in message[1]:
+                win_sequence = simulator.play_game(game_id, {})
+                profile = simulator.profiler.take() if simulator.profiler is not None else None
+                connection.send(('game', game_id, win_sequence, profile))
+            connection.send(('done',))
+    except (OSError, EOFError):
+        pass
+    finally:
+        connection.close()
+
+
+def start_workers(address, authkey, processes):
+    """Starts spawned (not forked) worker processes on this machine, and returns them"""
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_worker, args=(address, authkey), daemon=True)
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play games for a coordinator")
+    parser.add_argument("address", help="host:port of the coordinator")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    authkey = authkey_from_env()
+    if authkey is None:
+        parser.error("the SUPERSYMMETRY_AUTHKEY environment variable must be set")
+    for worker in start_workers(parse_address(args.address), authkey, args.processes):
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class LinearEvaluator(object):
+    """Scores a batch of candidate plays as a weighted sum of features.
+
+    The plays are given as arrays with the index (in board.board_spots) of the spot each play
+    starts from and ends in, along with the progress the player reported for each play.
+    Features with zero weight are not computed.
+
+    Features:
+    * progress: the progress reported by the player
+    * pieces_home: how many more pieces are in the target home after the play (-1, 0 or 1)
+    * stragglers: how much the progress of the rearmost piece increases
+    * mobility: how many more free neighbours the moved piece has
+    """
+    FEATURES = ('progress', 'pieces_home', 'stragglers', 'mobility')
+
+    def __init__(self, progress=1.0, pieces_home=0.0, stragglers=0.0, mobility=0.0):
+        self.weights = {
+            'progress': progress,
+            'pieces_home': pieces_home,
+            'stragglers': stragglers,
+            'mobility': mobility,
+        }
+
+    def __repr__(self):
+        return "LinearEvaluator({})".format(", ".join("{}={}".format(key, value) for key, value in self.weights.items()))
+
+    def __call__(self, game, color, progress, starts, ends):
+        scores = np.zeros(len(starts))
+        for feature, weight in self.weights.items():
+            if weight:
+                scores += weight * getattr(self, feature)(game, color, progress, starts, ends)
+        return scores
+
+    def features(self, game, color, progress, starts, ends):
+        """Returns every feature as a column of an (n_plays, n_features) array"""
+        return np.column_stack([
+            getattr(self, feature)(game, color, progress, starts, ends)
+            for feature in self.FEATURES
+        ])
+
+    def progress(self, game, color, progress, starts, ends):
+        return np.asarray(progress, dtype=float)
+
+    def pieces_home(self, game, color, progress, starts, ends):
+        board = game.board
+        target = board.home_masks[board.opposing[color]]
+        return target[ends].astype(float) - target[starts]
+
+    def stragglers(self, game, color, progress, starts, ends):
+        board = game.board
+        spot_progress = board.spot_array @ board.progress_vectors[color]
+        pieces = spot_progress[[board.spot_index[spot] for spot in game.player_spots[color]]]
+
+        # The rearmost piece after the play is either the rearmost of the pieces that stay,
+        # or the piece that moved
+        minimum = pieces.min()
+        n_at_minimum = np.count_nonzero(pieces == minimum)
+        second = np.partition(pieces, 1)[1] if len(pieces) > 1 else minimum
+        others = np.where((spot_progress[starts] == minimum) & (n_at_minimum == 1), second, minimum)
+        return np.minimum(others, spot_progress[ends]).astype(float) - minimum
+
+    def mobility(self, game, color, progress, starts, ends):
+        board = game.board
+        n_spots = len(board.board_spots)
+
+        # Spots outside of the board (index -1) count as blocked
+        blocked = np.ones(n_spots + 1, dtype=bool)
+        blocked[:n_spots] = False
+        for spots in game.player_spots.values():
+            blocked[[board.spot_index[spot] for spot in spots]] = True
+        free = np.count_nonzero(~blocked[board.neighbours], axis=1)
+        return free[ends].astype(float) - free[starts]
+
+
+# Scores plays by progress alone
+PROGRESS_EVALUATOR = LinearEvaluator()
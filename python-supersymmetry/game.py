@@ -1,8 +1,12 @@
+import asyncio
+from bisect import bisect_left, bisect_right
 from enum import Enum
+import inspect
 
 import numpy as np
 
-from board import Board, BoardPlotter
+from board import Board
+from timecontrol import NO_DEADLINE
 
 class InvalidMoveException(Exception):
     pass
@@ -18,17 +22,52 @@ class MoveState(Enum):
 class Game(object):
     TRUST_PLAYERS = False
     
-    def __init__(self, players, n=4):
-        self.board = Board(n)
+    def __init__(self, players, n=4, board=None, large_board=None):
+        # The board geometry can be shared between games of the same size
+        self.board = board if board is not None else Board(n)
         self.players = players
         self.player_spots = {
             color: spots.copy()
             for color, spots in self.board.color_spots.items()
             if color in players
         }
-        self.cache_occupied = {}
         self.move_stack = []
 
+        # On large boards, moves are found by walking along the rays from a piece,
+        # rather than by looking at every spot on the board
+        self.large_board = self.board.n >= 10 if large_board is None else large_board
+
+        # The number of plays made in the game so far
+        self.plies = 0
+
+        # The id of the game in a simulation, set by the Simulator
+        self.game_id = None
+
+        # Players should return their best play so far when the deadline expires
+        self.deadline = NO_DEADLINE
+
+    @property
+    def player_spots(self):
+        return self._player_spots
+
+    @player_spots.setter
+    def player_spots(self, player_spots):
+        # Setting up a new position invalidates what is known about which spots are occupied
+        self._player_spots = player_spots
+        self.cache_occupied = {}
+        self._occupancy = None
+
+    @property
+    def occupancy(self):
+        """Whether each spot in board_spots is occupied, as a bytearray that is kept up to date by do_move"""
+        if self._occupancy is None:
+            spot_index = self.board.spot_index
+            self._occupancy = bytearray(len(self.board.board_spots))
+            for spots in self.player_spots.values():
+                for spot in spots:
+                    self._occupancy[spot_index[spot]] = 1
+        return self._occupancy
+
     def get_line(self, vec_in, vec_out):
         """Find the line of coordinates from vec_in to vec_out.
         This code is currently the main hot path
@@ -76,6 +115,10 @@ class Game(object):
         self.cache_occupied[spot] = False
         return False
 
+    def position(self):
+        """Returns a hashable snapshot of where every piece is"""
+        return tuple(frozenset(spots) for spots in self.player_spots.values())
+
     def occupation(self, line, vec_in):
         """Returns whether each spot in the line is occupied"""
         return [self.occupied(spot) and spot != vec_in for spot in line]
@@ -89,6 +132,9 @@ class Game(object):
         if move_state == MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE:
             return False, move_state
         
+        if self.large_board:
+            return self.is_legal_ray_move(vec_in, vec_out, move_state)
+        
         # Cannot stop in an occupied spot
         if self.occupied(vec_out):
             return False, move_state
@@ -118,8 +164,148 @@ class Game(object):
                 no_occupation = False
         return (not no_occupation), MoveState.SUBSEQUENT
     
+    def is_legal_ray_move(self, vec_in, vec_out, move_state):
+        """is_legal_move for large boards: walks along the ray from vec_in to vec_out"""
+        board = self.board
+        steps = max(abs(xo - xi) for xi, xo in zip(vec_in, vec_out))
+        if steps == 0:
+            return False, move_state
+        direction = board.direction_index.get(tuple((xo - xi) // steps for xi, xo in zip(vec_in, vec_out)))
+        if direction is None or any((xo - xi) % steps for xi, xo in zip(vec_in, vec_out)):
+            return False, move_state
+        
+        # Occupation of the spots strictly between vec_in and vec_out
+        occupancy = self.occupancy
+        neighbours = board.neighbour_table
+        i = board.spot_index[vec_in]
+        between = bytearray()
+        for _ in range(steps):
+            i = neighbours[i][direction]
+            if i < 0:
+                return False, move_state
+            between.append(occupancy[i])
+        if between.pop():
+            return False, move_state
+        
+        # Special rule: 1-step moves need not be symmetric
+        if steps == 1 and move_state == MoveState.FIRST:
+            return True, MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE
+        
+        # Line through position must be symmetric, and jump over something
+        if between != between[::-1]:
+            return False, move_state
+        return any(between), MoveState.SUBSEQUENT
+    
+    def get_legal_ray_moves(self, vec_in, move_state):
+        """get_legal_moves for large boards: only looks at the spots along the six rays from vec_in"""
+        if move_state == MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE:
+            return []
+        board = self.board
+        occupancy = self.occupancy
+        neighbours = board.neighbour_table
+        start = board.spot_index[vec_in]
+        found = []
+        for direction in range(len(neighbours[start])):
+            # Walk along the ray until the edge of the board,
+            # and keep the occupation of the spots that have been passed
+            between = bytearray()
+            i = neighbours[start][direction]
+            while i >= 0:
+                if not occupancy[i]:
+                    if not between:
+                        if move_state == MoveState.FIRST:
+                            found.append((i, MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE))
+                    elif any(between) and between == between[::-1]:
+                        found.append((i, MoveState.SUBSEQUENT))
+                between.append(occupancy[i])
+                i = neighbours[i][direction]
+        
+        # In the same order as when looking at every spot on the board
+        found.sort(key=lambda move: move[0])
+        return [(board.board_spots[i], next_move_state) for i, next_move_state in found]
+    
+    def line_moves(self, player, pieces):
+        """Returns the legal first moves of the pieces with the given indices in player_spots[player],
+        as a list of (piece, index in board_spots of where it moves to, MoveState value after the move).
+
+        The occupancy of every line that the pieces are on is only looked up once. A jump must be symmetric
+        around its middle, so the spot it lands on is the mirror image of the first occupied spot it passes,
+        through one of the occupied spots after it; only those spots are looked at.
+        """
+        board = self.board
+        spot_index = board.spot_index
+        spots = self.player_spots[player]
+        single = MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE.value
+        jump = MoveState.SUBSEQUENT.value
+        
+        # Group the pieces by the lines they are on
+        line_pieces = {}
+        for piece in pieces:
+            for line, position in board.line_positions[spot_index[spots[piece]]]:
+                line_pieces.setdefault(line, []).append((piece, position))
+        
+        occupancy = self.occupancy
+        moves = []
+        for line, on_line in line_pieces.items():
+            cells = board.lines[line]
+            pattern = bytes(occupancy[i] for i in cells)
+            occupied = [position for position, cell in enumerate(pattern) if cell]
+            end = len(pattern)
+            for piece, position in on_line:
+                # Forwards along the line
+                if position + 1 < end and not pattern[position + 1]:
+                    moves.append((piece, cells[position + 1], single))
+                ahead = occupied[bisect_right(occupied, position):]
+                if ahead:
+                    gap = ahead[0] - position
+                    for other in ahead:
+                        landing = other + gap
+                        if landing >= end:
+                            break
+                        between = pattern[position + 1:landing]
+                        if not pattern[landing] and between == between[::-1]:
+                            moves.append((piece, cells[landing], jump))
+                
+                # Backwards along the line
+                if position > 0 and not pattern[position - 1]:
+                    moves.append((piece, cells[position - 1], single))
+                behind = occupied[bisect_left(occupied, position) - 1::-1] if occupied[0] < position else []
+                if behind:
+                    gap = position - behind[0]
+                    for other in behind:
+                        landing = other - gap
+                        if landing < 0:
+                            break
+                        between = pattern[landing + 1:position]
+                        if not pattern[landing] and between == between[::-1]:
+                            moves.append((piece, cells[landing], jump))
+        return moves
+    
+    def first_moves(self, player, pieces=None):
+        """Returns the legal first moves of the player's pieces (or of the pieces with the given indices)
+        as three arrays: the index of the piece in player_spots[player], the index in board_spots of
+        where it moves to, and the MoveState value after the move. The moves are sorted by piece, and the
+        moves of each piece are the same, in the same order, as get_legal_moves gives (see line_moves).
+        """
+        if pieces is None:
+            pieces = range(len(self.player_spots[player]))
+        moves = np.array(self.line_moves(player, pieces), dtype=np.intp).reshape(-1, 3)
+        moves = moves[np.lexsort((moves[:, 1], moves[:, 0]))]
+        return moves[:, 0], moves[:, 1], moves[:, 2].astype(np.int8)
+    
+    def first_moves_by_piece(self, player):
+        """Returns the legal first moves of every piece of the player in the format of get_legal_moves"""
+        board_spots = self.board.board_spots
+        move_states = { move_state.value: move_state for move_state in MoveState }
+        moves = [[] for _ in self.player_spots[player]]
+        for piece, spot, move_state in sorted(self.line_moves(player, range(len(moves)))):
+            moves[piece].append((board_spots[spot], move_states[move_state]))
+        return moves
+    
     def get_legal_moves(self, player, vec_in, move_state=MoveState.FIRST):
         """Gets all the legal moves in the board"""
+        if self.large_board:
+            return self.get_legal_ray_moves(vec_in, move_state)
         moves = []
         for vec_out in self.board.board_spots:
             legal, next_move_state = self.is_legal_move(player, vec_in, vec_out, move_state)
@@ -127,6 +313,35 @@ class Game(object):
                 moves.append((vec_out, next_move_state))
         return moves
     
+    def reachable(self, player, start, max_moves, first_moves=None):
+        """Returns the spots that the piece at start can reach in at most max_moves moves, other than start.
+        Every spot is only looked at once, and the positions the player has seen before are not avoided,
+        so this is cheap, and includes every spot a depth-first search of the same depth can reach.
+        The moves are found along the rays on any board, without moving the piece.
+        first_moves can be the legal first moves of the piece, if they are known already.
+        """
+        found = {(start, MoveState.FIRST)}
+        frontier = [(start, MoveState.FIRST)]
+        if first_moves is not None and max_moves > 0:
+            frontier = [move for move in first_moves if move not in found]
+            found.update(frontier)
+            max_moves -= 1
+        occupancy = self.occupancy
+        start_index = self.board.spot_index[start]
+        occupancy[start_index] = 0
+        try:
+            for _ in range(max_moves):
+                next_frontier = []
+                for spot, move_state in frontier:
+                    for move, next_move_state in self.get_legal_ray_moves(spot, move_state):
+                        if (move, next_move_state) not in found:
+                            found.add((move, next_move_state))
+                            next_frontier.append((move, next_move_state))
+                frontier = next_frontier
+        finally:
+            occupancy[start_index] = 1
+        return { spot for spot, _ in found if spot != start }
+    
     def is_legal_endpoint(self, player, vec_in, vec_out):
         """Returns whether vec_out is a legal place for a player piece to end up in"""
         # Can always end up in the same position
@@ -137,11 +352,9 @@ class Game(object):
         if self.occupied(vec_out):
             return False
         
-        for color, spots in self.board.color_spots.items():
-            if vec_out in spots:
-                if color == player or color == self.board.opposing[player]:
-                    return True
-                return False
+        color = self.board.home_of.get(vec_out)
+        if color is not None:
+            return color == player or color == self.board.opposing[player]
         
         # If the position is legal and in the field, we can end there
         if vec_out in self.board.field_spots:
@@ -158,6 +371,10 @@ class Game(object):
                 self.player_spots[player][idx] = vec_out
                 self.cache_occupied[vec_in] = False
                 self.cache_occupied[vec_out] = True
+                if self._occupancy is not None:
+                    spot_index = self.board.spot_index
+                    self._occupancy[spot_index[vec_in]] = 0
+                    self._occupancy[spot_index[vec_out]] = 1
                 return True
         return False
     
@@ -170,24 +387,31 @@ class Game(object):
         self.do_move(player, vec_out, vec_in, MoveState.ALREADY_CHECKED)
 
     def win_condition(self, player):
-        return all(spot in self.player_spots[player] for spot in self.board.color_spots[self.board.opposing[player]])
+        return set(self.player_spots[player]).issuperset(self.board.color_spots[self.board.opposing[player]])
     
     @property
     def pieces_per_player(self):
         return (self.board.n * (self.board.n + 1)) // 2
     
-    def run(self, max_steps, players, hooks):
+    def run(self, max_steps, players, hooks, time_control=None):
+        """Plays the game to the end, and returns the win sequence"""
         # Holds the winners in sorted order
         win_sequence = []
 
-        # Callbacks that may be ran during the game
+        if time_control:
+            time_control.start_game(players)
+
+        # Callbacks that may be ran during the game.
+        # Hooks that can be compiled are resolved to a dispatch table once, up front.
+        if hasattr(hooks, 'compile'):
+            hooks = hooks.compile()
         pre_game_callback  = hooks.get('before_game', None)
         game_callback      = hooks.get('after_game', None)
         pre_move_callback  = hooks.get('before_move', None)
         move_callback      = hooks.get('after_move', None)
         pre_play_callback  = hooks.get('before_play', None)
         play_callback      = hooks.get('after_play', None)
-        pre_round_callback = hooks.get('after_round', None)
+        pre_round_callback = hooks.get('before_round', None)
         round_callback     = hooks.get('after_round', None)
 
         # Run pre-game callback
@@ -208,7 +432,13 @@ class Game(object):
                     pre_play_callback(color, player)
 
                 # Let the player decide on a sequence of moves
-                moves = player.play()
+                if time_control:
+                    self.deadline = time_control.start_play(color)
+                    moves = player.play()
+                    time_control.end_play(color)
+                    self.deadline = NO_DEADLINE
+                else:
+                    moves = player.play()
 
                 # Run through them
                 start = moves[0]
@@ -227,6 +457,8 @@ class Game(object):
                     # The start of the next move is the end of this move
                     start = end
 
+                self.plies += 1
+
                 # Run post-play callback
                 if play_callback:
                     play_callback(color, player, moves)
@@ -249,7 +481,7 @@ class Game(object):
 
             # Run post-round callback
             if round_callback:
-                round_callback()        
+                round_callback()
 
         # Max steps reached
         if game_callback:
@@ -258,15 +490,123 @@ class Game(object):
             win_sequence.append((color, max_steps))
         return win_sequence
 
-class GamePlotter(object):
-    def __init__(self, game, transformer):
-        self.board_plotter = BoardPlotter(game.board, transformer)
-        self.game = game
-    
-    def plot(self, text=False):
-        self.board_plotter.plot_spots(text)
-        for color, spots in self.game.player_spots.items():
-            self.board_plotter.show_spots(spots, newfig=False, color=color, s=100)   
-    
-    def __getattr__(self, attr):
-        return getattr(self.board_plotter, attr)
\ No newline at end of file
+
+    async def run_async(self, max_steps, players, hooks, time_control=None, executor=None):
+        """Plays the game to the end on the running event loop, and returns the win sequence.
+        Players whose play method is a coroutine function are awaited, and the other players
+        play in the executor (by default the loop's thread pool). Hooks that return awaitables are awaited.
+        """
+        loop = asyncio.get_running_loop()
+        steps = self.steps(max_steps, players, hooks, time_control)
+        result = None
+        try:
+            while True:
+                func, args, is_play = steps.send(result)
+                if is_play and not inspect.iscoroutinefunction(func):
+                    result = await loop.run_in_executor(executor, func, *args)
+                else:
+                    result = func(*args)
+                    if inspect.isawaitable(result):
+                        result = await result
+        except StopIteration as stop:
+            return stop.value
+
+    def steps(self, max_steps, players, hooks, time_control=None):
+        """The game loop of run_async, as a generator; run keeps a plain loop of its own, which is cheaper.
+        It yields each call to a player or a hook as (function, args, whether it is a play),
+        expects the result to be sent back, and returns the win sequence.
+        """
+        # Holds the winners in sorted order
+        win_sequence = []
+
+        if time_control:
+            time_control.start_game(players)
+
+        # Callbacks that may be ran during the game.
+        # Hooks that can be compiled are resolved to a dispatch table once, up front.
+        if hasattr(hooks, 'compile'):
+            hooks = hooks.compile()
+        pre_game_callback  = hooks.get('before_game', None)
+        game_callback      = hooks.get('after_game', None)
+        pre_move_callback  = hooks.get('before_move', None)
+        move_callback      = hooks.get('after_move', None)
+        pre_play_callback  = hooks.get('before_play', None)
+        play_callback      = hooks.get('after_play', None)
+        pre_round_callback = hooks.get('before_round', None)
+        round_callback     = hooks.get('after_round', None)
+
+        # Run pre-game callback
+        if pre_game_callback:
+            yield pre_game_callback, (self,), False
+
+        # Run until max steps is reached or all players have arrived
+        for step in range(max_steps):
+            # Run pre-round callback
+            if pre_round_callback:
+                yield pre_round_callback, (), False
+
+            # Let every player move
+            winners_this_round = []
+            for color, player in players.items():
+                # Run pre-play callback
+                if pre_play_callback:
+                    yield pre_play_callback, (color, player), False
+
+                # Let the player decide on a sequence of moves
+                if time_control:
+                    self.deadline = time_control.start_play(color)
+                    moves = yield player.play, (), True
+                    time_control.end_play(color)
+                    self.deadline = NO_DEADLINE
+                else:
+                    moves = yield player.play, (), True
+
+                # Run through them
+                start = moves[0]
+                for end in moves[1:]:
+                    # Run pre-move callback
+                    if pre_move_callback:
+                        yield pre_move_callback, (start, end), False
+
+                    # Perform the move
+                    self.do_move(color, start, end)
+
+                    # Run post-move callback
+                    if move_callback:
+                        yield move_callback, (start, end), False
+
+                    # The start of the next move is the end of this move
+                    start = end
+
+                self.plies += 1
+
+                # Run post-play callback
+                if play_callback:
+                    yield play_callback, (color, player, moves), False
+
+                # Check if the player has won
+                if self.win_condition(color):
+                    win_sequence.append((color, step))
+                    winners_this_round.append(color)
+
+            # If any players won this round, remove them from list of players
+            if winners_this_round:
+                # Eliminate the winners
+                players = { color: player for color, player in players.items() if color not in winners_this_round }
+
+                # The game ends when there are no more players
+                if len(players) == 0:
+                    if game_callback:
+                        yield game_callback, (), False
+                    return win_sequence
+
+            # Run post-round callback
+            if round_callback:
+                yield round_callback, (), False
+
+        # Max steps reached
+        if game_callback:
+            yield game_callback, (), False
+        for color, player in players.items():
+            win_sequence.append((color, max_steps))
+        return win_sequence
@@ -1,19 +1,41 @@
 from collections import defaultdict
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 
-from coordinate_transformer import CoordinateTransformer
-from game import GamePlotter
+from results import GrowableArray, ResultStore
+
+
+# The points in Game.run where callbacks are run
+HOOK_POINTS = (
+    'before_game',
+    'after_game',
+    'before_round',
+    'after_round',
+    'before_play',
+    'after_play',
+    'before_move',
+    'after_move',
+)
+
+
+def compile_hooks(hooks):
+    """Returns a dispatch table from hook point to callback for any object with a get method.
+    Only the hook points that have a callback are included.
+    """
+    if hasattr(hooks, 'compile'):
+        return hooks.compile()
+    callbacks = ((name, hooks.get(name, None)) for name in HOOK_POINTS)
+    return { name: callback for name, callback in callbacks if callback is not None }
 
 
 class GameHooks(object):
     def get(self, callback_name, default=None):
-        if hasattr(self, callback_name):
-            return lambda *args, **kwargs: getattr(self, callback_name)(*args, **kwargs)
-        else:
-            return default
+        return getattr(self, callback_name, default)
+
+    def compile(self):
+        """Returns a dispatch table from hook point to bound method, for the hook points that are implemented"""
+        callbacks = ((name, self.get(name, None)) for name in HOOK_POINTS)
+        return { name: callback for name, callback in callbacks if callback is not None }
 
 
 class NoHooks(GameHooks):
@@ -29,74 +51,88 @@ class MultiHooks(GameHooks):
         self.hooks.append(hook)
     
     def get(self, callback_name, default=None):
-        hooks_with_callback = [hook for hook in self.hooks if hasattr(hook, callback_name)]
-        if not hooks_with_callback:
-            return default
-        
-        def callback(*args, **kwargs):
-            for hook in hooks_with_callback:
-                getattr(hook, callback_name)(*args, **kwargs)
+        return self.compile().get(callback_name, default)
+
+    def compile(self):
+        tables = [compile_hooks(hook) for hook in self.hooks]
+        dispatch = {}
+        for name in HOOK_POINTS:
+            callbacks = tuple(table[name] for table in tables if name in table)
+            if len(callbacks) == 1:
+                # No need to wrap a single listener
+                dispatch[name] = callbacks[0]
+            elif callbacks:
+                dispatch[name] = self.fan_out(callbacks)
+        return dispatch
+
+    @staticmethod
+    def fan_out(callbacks):
+        def callback(*args):
+            for callback_ in callbacks:
+                callback_(*args)
         return callback
 
 
-class ProgressTrackerHooks(GameHooks):
-    def __init__(self):
-        self.progress = []
-        self.progress_for_this_game = defaultdict(list)
-    
-    def before_game(self, _):
-        self.progress_for_this_game = defaultdict(list)
-    
-    def after_play(self, color, player, _):
-        self.progress_for_this_game[color].append(player.total_progress())
-    
-    def after_game(self):
-        self.progress.append(self.progress_for_this_game)
-
-
-class PlotHooks(GameHooks):
-    def __init__(self,
-                 transform=np.array([
-                    [    1,            0 ],
-                    [ -1/2, np.sqrt(3)/2 ],
-                    [  1/2, np.sqrt(3)/2 ],
-                 ]),
-                 fig_format="hexgrid-figures/tree-{}.png",
-                 save_fig=False):
-        self.transform = transform
-        self.save_fig = save_fig
-        self.fig_format = fig_format
+class EventRecorderHooks(GameHooks):
+    """Records the plays and moves of a game in arrays, and delivers them all at once after the game.
+
+    The moves are taken from the path of each play, so nothing runs for the individual moves.
+    After each game, on_game is called with the colors, the plays and the moves.
+    Without on_game, the recordings are collected in the games attribute.
+    """
+    PLAY_DTYPE = np.dtype([
+        ('play', np.int32),
+        ('color', np.int8),
+        ('first_move', np.int32),
+        ('n_moves', np.int16),
+    ])
+    MOVE_DTYPE = np.dtype([
+        ('play', np.int32),
+        ('start', np.int16, (3,)),
+        ('end', np.int16, (3,)),
+    ])
+
+    def __init__(self, on_game=None):
+        self.on_game = on_game
+        self.games = []
+        self.plays = GrowableArray(self.PLAY_DTYPE, 256)
+        self.moves = GrowableArray(self.MOVE_DTYPE, 1024)
 
     def before_game(self, game):
-        mpl.style.use("default")
-        self.play_counter = 0
-        
-        self.plotter = GamePlotter(
-            game,
-            transformer=CoordinateTransformer(
-                transform=np.array(self.transform)
-            )
-        )
-        
-        self.plotter.plot(text=True)
-        self.xlim = plt.xlim()
-        self.ylim = plt.ylim()
-    
-    def after_move(self, start, end):
-        self.plotter.plot_move(start, end)
-
-    def before_play(self, *_):
-        self.plotter.plot()
-        
-    def after_play(self, *_):
-        self.play_counter += 1
-        plt.xticks([])
-        plt.yticks([])
-        plt.xlim(self.xlim)
-        plt.ylim(self.ylim)
-        
-        if self.save_fig:
-            plt.savefig(self.fig_format.format(self.play_counter))
-            plt.close()
+        self.colors = list(game.player_spots)
+        self.color_indices = { color: i for i, color in enumerate(self.colors) }
+        self.plays.clear()
+        self.moves.clear()
+
+    def after_play(self, color, player, moves):
+        play = len(self.plays)
+        self.plays.append((play, self.color_indices[color], len(self.moves), len(moves) - 1))
+        self.moves.extend([(play, start, end) for start, end in zip(moves[:-1], moves[1:])])
+
+    def after_game(self):
+        plays = self.plays.data.copy()
+        moves = self.moves.data.copy()
+        if self.on_game:
+            self.on_game(self.colors, plays, moves)
         else:
-            plt.show()
\ No newline at end of file
+            self.games.append((self.colors, plays, moves))
+
+
+class ProgressTrackerHooks(GameHooks):
+    def __init__(self, store=None):
+        self.store = store if store is not None else ResultStore()
+        self.game_id = -1
+        self.plays = defaultdict(int)
+
+    @property
+    def progress(self):
+        return self.store.progress_dicts()
+
+    def before_game(self, game):
+        # Games played by a Simulator know their id, which does not start over when a run is resumed
+        self.game_id = game.game_id if game.game_id is not None else self.game_id + 1
+        self.plays = defaultdict(int)
+
+    def after_play(self, color, player, _):
+        self.store.add_progress(self.game_id, color, self.plays[color], player.total_progress())
+        self.plays[color] += 1
@@ -0,0 +1,164 @@
+"""Opening books: the best known play in the early positions of a game, learned from self-play.
+Build one with python opening_book.py config.json --games 10000 --depth 12 --output book.npy
+"""
+import argparse
+from collections import defaultdict
+import json
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from hooks import GameHooks
+from results import match_score
+from state import GameState
+
+
+# The longest play that can be stored in a book
+MAX_PATH = 16
+
+BOOK_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('games', '<u4'),
+    ('score', '<f4'),
+    ('path', '<i2', (MAX_PATH,)),
+])
+
+
+class OpeningRecorderHooks(GameHooks):
+    """Records the position key and the play of the first depth plays of a game"""
+    def __init__(self, depth):
+        self.depth = depth
+        self.plays = []
+
+    def before_game(self, game):
+        self.game = game
+        self.plays = []
+
+    def before_play(self, color, player):
+        self.key = None
+        if self.game.plies < self.depth:
+            self.key = GameState.from_game(self.game, color).digest()
+
+    def after_play(self, color, player, moves):
+        if self.key is not None and len(moves) <= MAX_PATH:
+            spot_index = self.game.board.spot_index
+            self.plays.append((self.key, color, tuple(spot_index[spot] for spot in moves)))
+
+
+# The simulator used by each worker process in build_book
+worker_simulator = None
+
+
+def init_worker(simulator):
+    global worker_simulator
+    worker_simulator = simulator
+
+
+def record_openings(args):
+    """Plays one game and returns (key, path, score for the color that played it) for its opening plays"""
+    game_id, depth = args
+    hooks = OpeningRecorderHooks(depth)
+    win_sequence = worker_simulator.play_game(game_id, hooks.compile())
+    return [(key, path, match_score(win_sequence, color)) for key, color, path in hooks.plays]
+
+
+def build_book(simulator, n_games, depth, path, workers=None, min_games=1):
+    """Plays n_games of self-play and writes a book of the best scoring play, made at least min_games times,
+    in each of the positions of the first depth plays to path. Returns the book."""
+    workers = workers if workers else os.cpu_count()
+
+    # A seed drawn for the run is only given to the workers, and the simulator keeps the one it was given
+    worker_copy = simulator.worker_copy()
+    if worker_copy.seed is None:
+        worker_copy.seed = random.randrange(2**32)
+
+    # (key, path) -> [games, total score]
+    stats = defaultdict(lambda: [0, 0.0])
+    tasks = [(game_id, depth) for game_id in range(n_games)]
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(worker_copy,)) as pool:
+        for plays in pool.imap_unordered(record_openings, tasks, chunksize=8):
+            for key, play_path, score in plays:
+                entry = stats[key, play_path]
+                entry[0] += 1
+                entry[1] += score
+
+    # Keep the best play for each position
+    best = {}
+    for (key, play_path), (games, score) in stats.items():
+        if games < min_games:
+            continue
+        rank = (score / games, games, tuple(-i for i in play_path))
+        if key not in best or rank > best[key][0]:
+            best[key] = (rank, play_path, games)
+
+    entries = np.zeros(len(best), dtype=BOOK_DTYPE)
+    entries['path'] = -1
+    for i, key in enumerate(sorted(best)):
+        (mean_score, _, _), play_path, games = best[key]
+        entries[i]['key'] = key
+        entries[i]['games'] = games
+        entries[i]['score'] = mean_score
+        entries[i]['path'][:len(play_path)] = play_path
+    np.save(path, entries)
+    return OpeningBook(path)
+
+
+class OpeningBook(object):
+    """A book written by build_book, memory-mapped from path"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = np.load(path, mmap_mode='r')
+        self.keys = self.entries['key']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __reduce__(self):
+        # Map the file again where the book is unpickled, rather than copying the entries
+        return (OpeningBook, (self.path,))
+
+    def entry(self, key):
+        """Returns the entry for the position key, or None"""
+        i = np.searchsorted(self.keys, np.uint64(key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self.entries[i]
+
+    def lookup(self, game, color):
+        """Returns the book play for the color in the game's current position, or None"""
+        entry = self.entry(GameState.from_game(game, color).digest())
+        if entry is None:
+            return None
+        board_spots = game.board.board_spots
+        play = [board_spots[i] for i in entry['path'] if i >= 0]
+
+        # Position keys can collide, so check that the play can be made here
+        if play[0] not in game.player_spots[color] or game.occupied(play[-1]):
+            return None
+        return play
+
+
+def main(argv=None):
+    # simulate.py opens books named in the player params, so it is imported here rather than at the top
+    from simulate import simulator_from_config
+
+    parser = argparse.ArgumentParser(description="Build an opening book from self-play")
+    parser.add_argument("config", help="JSON config file, as for simulate.py")
+    parser.add_argument("--games", type=int, default=1000, help="number of self-play games")
+    parser.add_argument("--depth", type=int, default=12, help="number of plays from the start to put in the book")
+    parser.add_argument("--min-games", type=int, default=1, help="how often a play must have been made to be kept")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--output", default="book.npy", help="where to write the book")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    simulator = simulator_from_config(config)
+    book = build_book(simulator, args.games, args.depth, args.output, workers=args.workers, min_games=args.min_games)
+    print("{} positions written to {}".format(len(book), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import multiprocessing
+import os
+
+from players import NonPlanningProgressMaximizer, PlanningProgressMaximizer
+from state import GameState
+from timecontrol import Deadline
+
+
+def worker_game(state, seconds):
+    """Rebuilds the position in a worker, with the time that is left of the deadline"""
+    game = state.to_game()
+    game.deadline = Deadline(seconds)
+    return game
+
+
+def search_piece(task):
+    """Returns the plays of one piece, like DepthFirstMoveFinderMixin.moves_for_piece. Runs in the workers."""
+    state, color, params, explored_positions, start_spot, seconds = task
+    game = worker_game(state, seconds)
+    finder = NonPlanningProgressMaximizer(color, game, params)
+    finder.explored_positions = explored_positions
+    return list(finder.moves_for_piece(start_spot))
+
+
+def explore_play(task):
+    """Explores one play from the root, like PlanningProgressMaximizer.explore_play. Runs in the workers.
+    Also returns the positions that were added to the explored positions.
+    """
+    state, color, params, opponents, memory, explored_positions, play, seconds = task
+    game = worker_game(state, seconds)
+    player = PlanningProgressMaximizer(color, game, params)
+    player.move_finder.explored_positions = memory
+    player.opponent_models = [
+        opponent_class(name, game, opponent_params)
+        for opponent_class, name, opponent_params in opponents
+    ]
+    explored = set(explored_positions)
+    outcome = player.explore_play(0, explored, play, play)
+    return outcome, explored - explored_positions
+
+
+class SearchPool(object):
+    """A persistent pool of processes that searches the candidate plays from the root of a search in parallel.
+
+    Give it to NonPlanningProgressMaximizer, RandomPlayer or PlanningProgressMaximizer as params['search_pool'].
+    Each worker rebuilds the position from a GameState. The depth-first move search is split by piece,
+    and the results are merged in piece order, so the plays are the same as in the serial search.
+
+    The plays from the root of a planning search are explored speculatively, from the positions that
+    were explored before the first of them. They are then checked in the serial order: a play that reached
+    a position that an earlier play explored is explored again, serially, so that it sees the same explored
+    positions as in the serial search. The opponent models in the workers start from a copy of their params,
+    so opponents that break ties at random or remember the positions they have seen can respond differently
+    than in the serial search.
+
+    A pool that is pickled (e.g. in the params sent to a Simulator worker) searches serially where it is unpickled.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes if processes else os.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes)
+        self.speculated = 0
+        self.recomputed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return { 'processes': self.processes }
+
+    def __setstate__(self, state):
+        self.processes = state['processes']
+        self.pool = None
+        self.speculated = 0
+        self.recomputed = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def map(self, func, tasks):
+        if self.pool is None:
+            return list(map(func, tasks))
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def piece_moves(self, player):
+        """Returns the plays of every piece of the player, in the order of its pieces"""
+        game = player.game
+        state = GameState.from_game(game)
+        explored_positions = player.explored_positions.copy()
+        params = { key: value for key, value in player.params.items() if key != 'search_pool' }
+        tasks = [
+            (state, player.name, params, explored_positions, start_spot, game.deadline.remaining())
+            for start_spot in game.player_spots[player.name]
+        ]
+        return [move for moves in self.map(search_piece, tasks) for move in moves]
+
+    def play_explorer(self, player, plays, explored_positions):
+        """Explores the plays in parallel, and returns a function that stands in for player.explore_play
+        at the root, and that gives their outcomes in the order the serial search asks for them
+        """
+        game = player.game
+        state = GameState.from_game(game)
+        params = {
+            key: value for key, value in player.params.items()
+            if key not in ('search_pool', 'opponent_models')
+        }
+        opponents = [(type(opponent), opponent.name, opponent.params) for opponent in player.opponent_models]
+        memory = player.move_finder.explored_positions.copy()
+        base = frozenset(explored_positions)
+        tasks = [
+            (state, player.name, params, opponents, memory, base, play, game.deadline.remaining())
+            for play in plays
+        ]
+        outcomes = iter(self.map(explore_play, tasks))
+        self.speculated += len(tasks)
+
+        def explore_play_at_root(depth, explored_positions, play, move):
+            outcome, added = next(outcomes)
+            if added.isdisjoint(explored_positions):
+                explored_positions.update(added)
+                return outcome
+            self.recomputed += 1
+            return player.explore_play(depth, explored_positions, play, move)
+        return explore_play_at_root
@@ -0,0 +1,144 @@
+from collections import namedtuple
+import sys
+import time
+
+from game import Game, MoveState
+
+
+PerftResult = namedtuple('PerftResult', ['nodes', 'seconds', 'nodes_per_second'])
+
+
+# Number of positions after the given number of plays from the starting position, keyed by (n, colors, depth)
+REFERENCE_COUNTS = {
+    (2, ("red", "black"), 1): 6,
+    (2, ("red", "black"), 2): 36,
+    (2, ("red", "black"), 3): 384,
+    (3, ("red", "black"), 1): 12,
+    (3, ("red", "black"), 2): 144,
+    (3, ("red", "black"), 3): 2880,
+    (3, ("red", "green", "black"), 2): 157,
+    (3, ("red", "green", "black"), 3): 2284,
+    (4, ("red", "black"), 1): 20,
+    (4, ("red", "black"), 2): 400,
+    (4, ("red", "yellow", "green", "black", "blue", "grey"), 2): 463,
+}
+
+
+def reachable(game, color, spot, move_state, visited, legal_moves=None):
+    """Adds every (spot, move state) reachable by the piece at spot to visited.
+    legal_moves can be the legal moves from spot, if they are known already.
+    """
+    if legal_moves is None:
+        legal_moves = game.get_legal_moves(color, spot, move_state)
+    for move, next_move_state in legal_moves:
+        if (move, next_move_state) in visited:
+            continue
+        visited.add((move, next_move_state))
+        game.push_move(color, spot, move, move_state)
+        reachable(game, color, move, next_move_state, visited)
+        game.pop_move()
+
+
+def legal_plays(game, color, whole_position=False):
+    """Returns every distinct play for the color as a sorted list of (start, end) pairs.
+    A play can have any number of moves, and must end in a spot that passes is_legal_endpoint.
+    With whole_position, the first moves of all the pieces come from Game.first_moves_by_piece.
+    """
+    plays = set()
+    starts = list(game.player_spots[color])
+    first_moves = game.first_moves_by_piece(color) if whole_position else [None] * len(starts)
+    for start, legal_moves in zip(starts, first_moves):
+        visited = set()
+        reachable(game, color, start, MoveState.FIRST, visited, legal_moves)
+        for end, _ in visited:
+            if end != start and game.is_legal_endpoint(color, start, end):
+                plays.add((start, end))
+    return sorted(plays)
+
+
+def whole_position_plays(game, color):
+    return legal_plays(game, color, whole_position=True)
+
+
+def perft(game, color, depth, generator=legal_plays):
+    """Counts the positions after depth plays, starting with the color and following the order of the colors in the game"""
+    if depth == 0:
+        return 1
+    plays = generator(game, color)
+    if depth == 1:
+        return len(plays)
+
+    colors = list(game.player_spots)
+    next_color = colors[(colors.index(color) + 1) % len(colors)]
+    nodes = 0
+    for start, end in plays:
+        game.push_move(color, start, end, MoveState.ALREADY_CHECKED)
+        nodes += perft(game, next_color, depth - 1, generator)
+        game.pop_move()
+    return nodes
+
+
+def timed_perft(game, color, depth, generator=legal_plays):
+    t0 = time.perf_counter()
+    nodes = perft(game, color, depth, generator)
+    seconds = time.perf_counter() - t0
+    return PerftResult(nodes, seconds, nodes / seconds if seconds else float('inf'))
+
+
+def check_reference(generator=legal_plays, max_n=None, large_board=False):
+    """Runs perft for the reference positions, with the move generation of large boards if large_board is set.
+    Returns a list of (n, colors, depth, expected, result) for each of them.
+    """
+    rows = []
+    for (n, colors, depth), expected in REFERENCE_COUNTS.items():
+        if max_n is not None and n > max_n:
+            continue
+        game = Game(colors, n, large_board=large_board)
+        result = timed_perft(game, colors[0], depth, generator)
+        rows.append((n, colors, depth, expected, result))
+    return rows
+
+
+def scaling(ns=(4, 8, 12, 16, 24, 32), colors=("red", "black"), max_area_n=12):
+    """Times the plays from the starting position on boards of each size, per play, walking along the rays
+    from each piece and, up to max_area_n, looking at every spot on the board.
+    Returns a list of (n, number of spots, plays, seconds per play walking the rays, seconds per play looking
+    at every spot or None); the first grows with the length of the rays, the second with the area of the board.
+    """
+    rows = []
+    for n in ns:
+        seconds = []
+        for large_board in (True, False):
+            if not large_board and n > max_area_n:
+                seconds.append(None)
+                continue
+            game = Game(colors, n, large_board=large_board)
+            t0 = time.perf_counter()
+            plays = legal_plays(game, colors[0])
+            seconds.append((time.perf_counter() - t0) / len(plays))
+        rows.append((n, len(game.board.board_spots), len(plays), seconds[0], seconds[1]))
+    return rows
+
+
+if __name__ == "__main__":
+    # Usage: python perft.py [max n] [--large-board] [--whole-position] [--scaling]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--scaling" in sys.argv:
+        for n, spots, plays, ray_seconds, area_seconds in scaling():
+            print("n={} ({} spots): {} plays, {:.0f} us per play along the rays, {} per play over every spot".format(
+                n, spots, plays, ray_seconds * 1e6, "-" if area_seconds is None else "{:.0f} us".format(area_seconds * 1e6)
+            ))
+        sys.exit(0)
+    max_n = int(args[0]) if args else None
+    failures = 0
+    for n, colors, depth, expected, result in check_reference(
+        whole_position_plays if "--whole-position" in sys.argv else legal_plays,
+        max_n=max_n,
+        large_board="--large-board" in sys.argv,
+    ):
+        status = "ok" if result.nodes == expected else "MISMATCH (expected {})".format(expected)
+        failures += result.nodes != expected
+        print("n={} colors={} depth={}: {} nodes, {:.0f} nodes/s, {}".format(
+            n, ",".join(colors), depth, result.nodes, result.nodes_per_second, status
+        ))
+    sys.exit(1 if failures else 0)
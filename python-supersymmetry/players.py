@@ -1,10 +1,11 @@
-from collections import deque
+from collections import OrderedDict, deque
 import heapq
 import random
 
 import networkx as nx
 import numpy as np
 
+from evaluation import LinearEvaluator, PROGRESS_EVALUATOR
 from game import MoveState
 
 class Player(object):
@@ -31,41 +32,82 @@ class Player(object):
     def positions(self):
         return self.game.player_spots[self.name]
 
+    def book_play(self):
+        """Returns the play from params['opening_book'] for the current position, or None.
+        The book is only used for the first params['book_depth'] plays of the game, if given.
+        """
+        params = self.params or {}
+        book = params.get('opening_book')
+        if book is None:
+            return None
+        book_depth = params.get('book_depth')
+        if book_depth is not None and self.game.plies >= book_depth:
+            return None
+        return book.lookup(self.game, self.name)
+
 
 class DepthFirstMoveFinderMixin(object):
     """Explores the entire tree of possibilities"""
-    def positions(self):
-        raise NotImplementedError("No positions method defined")
-
     def __init__(self, name, game, params=None):
         self.name = name
         self.game = game
         self.params = params
-        self.explored_positions = deque([], maxlen=params.get('position_memory', 5))
+        self.explored_positions = deque([], maxlen=(params or {}).get('position_memory', 5))
 
     def moves(self):
         game = self.game
-        board = self.game.board
         
         self.explored_positions.append(frozenset(self.positions()))
         
+        # Search the pieces in parallel if there is a search pool
+        search_pool = (self.params or {}).get('search_pool')
+        if search_pool is not None:
+            yield from search_pool.piece_moves(self)
+            return
+        
+        # The first moves of all the pieces are found at once
+        first_moves = game.first_moves_by_piece(self.name)
+        
+        found_any = False
         for i in range(game.pieces_per_player):
-            start_spot = game.player_spots[self.name][i]
-            progress_before = board.progress_function[self.name](start_spot)
-            
-            move_tree = nx.DiGraph()
-            move_tree.add_node(start_spot)
+            # Out of time: settle for the plays found so far
+            if found_any and game.deadline.expired():
+                return
             
-            self.explore(start_spot, move_tree, MoveState.FIRST, 1)
-            for endpoint in move_tree.nodes():
-                if endpoint != start_spot and game.is_legal_endpoint(self.name, start_spot, endpoint):
-                    progress = board.progress_function[self.name](endpoint) - progress_before
-                    path = list(self.path(start_spot, endpoint, move_tree))
-                    yield progress, path
+            for progress, path in self.moves_for_piece(game.player_spots[self.name][i], first_moves[i]):
+                found_any = True
+                yield progress, path
 
-    def explore(self, start_spot, move_tree, move_state, depth):
+    def move_tree(self, start_spot, first_moves=None):
+        """Returns the tree of the moves of the piece at start_spot.
+        first_moves can be the legal first moves of the piece, if they are known already.
+        """
+        move_tree = nx.DiGraph()
+        move_tree.add_node(start_spot)
+        self.explore(start_spot, move_tree, MoveState.FIRST, 1, first_moves)
+        return move_tree
+
+    def moves_for_piece(self, start_spot, first_moves=None):
+        game = self.game
+        board = self.game.board
+        progress_before = board.progress_function[self.name](start_spot)
+        
+        move_tree = self.move_tree(start_spot, first_moves)
+        for endpoint in move_tree.nodes():
+            if endpoint != start_spot and game.is_legal_endpoint(self.name, start_spot, endpoint):
+                progress = board.progress_function[self.name](endpoint) - progress_before
+                path = list(self.path(start_spot, endpoint, move_tree))
+                yield progress, path
+
+    def explore(self, start_spot, move_tree, move_state, depth, legal_moves=None):
+        # Out of time: only the first level of moves is always explored
+        if depth > 1 and self.game.deadline.expired():
+            return
+        
         # Iterate over every legal move
-        for move, next_move_state in self.game.get_legal_moves(self.name, start_spot, move_state):
+        if legal_moves is None:
+            legal_moves = self.game.get_legal_moves(self.name, start_spot, move_state)
+        for move, next_move_state in legal_moves:
             # Don't go in circles
             if move in move_tree.nodes:
                 continue
@@ -101,15 +143,61 @@ class BaseProgressTracker(Player):
     def moves(self):
         raise NotImplementedError("No moves method defined")
 
+    @property
+    def evaluator(self):
+        """The evaluator that scores the candidate plays, given by the 'evaluator' param"""
+        return (self.params or {}).get('evaluator') or PROGRESS_EVALUATOR
+
     def play(self):
-        return self.choose(self.build_heap())
-    
+        book_play = self.book_play()
+        if book_play is not None:
+            return book_play
+        scores, plays = self.evaluate()
+        return self.choose_best(scores, plays)
+
+    def evaluate(self):
+        """Collects every candidate play, and scores them all in one vectorized call"""
+        progress = []
+        plays = []
+        for progress_, play in self.moves():
+            progress.append(progress_)
+            plays.append(play)
+        spot_index = self.game.board.spot_index
+        starts = np.array([spot_index[play[0]] for play in plays], dtype=np.intp)
+        ends = np.array([spot_index[play[-1]] for play in plays], dtype=np.intp)
+        scores = self.evaluator(self.game, self.name, progress, starts, ends)
+        return scores, plays
+
     def build_heap(self):
-        heap = []
-        for progress, move in self.moves():
-            heapq.heappush(heap, (-progress, move))
+        scores, plays = self.evaluate()
+        heap = [(-score, play) for score, play in zip(scores.tolist(), plays)]
+        heapq.heapify(heap)
         return heap
 
+    def top_k(self, k):
+        """Returns the k best plays, best first (in the order they would be popped from the heap)"""
+        return [play for _, play in self.scored_top_k(k)]
+
+    def scored_top_k(self, k):
+        """Returns the k best plays with their scores, as (score, play), best first"""
+        scores, plays = self.evaluate()
+        if k <= 0:
+            return []
+        if k < len(scores):
+            # Keep every play that ties with the k-th score, so that the ties are broken like in the heap
+            kth_score = -np.partition(-scores, k - 1)[k - 1]
+            candidates = np.flatnonzero(scores >= kth_score)
+        else:
+            candidates = range(len(scores))
+        best = sorted((-scores[i], plays[i]) for i in candidates)[:k]
+        return [(-minus_score, play) for minus_score, play in best]
+
+    def choose_best(self, scores, plays):
+        """Picks one of the plays with the highest score at random"""
+        rounded = np.round(scores, 2)
+        max_pool = sorted(plays[i] for i in np.flatnonzero(rounded == rounded.max()))
+        return random.choice(max_pool)
+
     def choose(self, heap):
         minus_max_progress, move = heapq.heappop(heap)
         max_pool = [move]
@@ -125,108 +213,346 @@ class BaseProgressTracker(Player):
             max_pool.append(move)
         return random.choice(max_pool)
 
-class NonPlanningProgressMaximizer(BaseProgressTracker, DepthFirstMoveFinderMixin):
-    """Look ma, no code"""
+class NonPlanningProgressMaximizer(DepthFirstMoveFinderMixin, BaseProgressTracker):
+    """Plays the play with the most progress, pruning the pieces that can not reach the best play
+    when the evaluator only scores progress (unless the param branch_and_bound is False)"""
+    def play(self):
+        book_play = self.book_play()
+        if book_play is not None:
+            return book_play
+        weight = self.progress_weight()
+        if weight is None:
+            return super().play()
+        return self.branch_and_bound(weight)
+
+    def progress_weight(self):
+        """Returns the weight of progress if the evaluator only scores progress and the search can be pruned, else None"""
+        params = self.params or {}
+        if not params.get('branch_and_bound', True) or params.get('search_pool') is not None:
+            return None
+        evaluator = self.evaluator
+        if not isinstance(evaluator, LinearEvaluator):
+            return None
+        weights = evaluator.weights
+        if weights['progress'] <= 0 or any(weight for feature, weight in weights.items() if feature != 'progress'):
+            return None
+        return weights['progress']
+
+    def branch_and_bound(self, weight):
+        game = self.game
+        progress_function = game.board.progress_function[self.name]
+        self.explored_positions.append(frozenset(self.positions()))
+        
+        # Bound the score of the plays of each piece, rounded like in choose_best
+        bounds = []
+        for start_spot, first_moves in zip(game.player_spots[self.name], game.first_moves_by_piece(self.name)):
+            progress_before = progress_function(start_spot)
+            reachable = [
+                progress_function(spot) - progress_before
+                for spot in game.reachable(self.name, start_spot, self.params['max_depth'], first_moves)
+                if game.is_legal_endpoint(self.name, start_spot, spot)
+            ]
+            if reachable:
+                bounds.append((np.round(weight * max(reachable), 2), start_spot, first_moves))
+        bounds.sort(key=lambda bound: -bound[0])
+        
+        best = None
+        max_pool = []
+        for bound, start_spot, first_moves in bounds:
+            # The rest of the pieces cannot do better
+            if best is not None and bound < best:
+                break
+            
+            # Out of time: settle for the plays found so far
+            if best is not None and game.deadline.expired():
+                break
+            
+            progress_before = progress_function(start_spot)
+            move_tree = self.move_tree(start_spot, first_moves)
+            for endpoint in move_tree.nodes():
+                if endpoint != start_spot and game.is_legal_endpoint(self.name, start_spot, endpoint):
+                    score = np.round(weight * (progress_function(endpoint) - progress_before), 2)
+                    if best is None or score > best:
+                        best = score
+                        max_pool = []
+                    if score == best:
+                        max_pool.append((start_spot, endpoint, move_tree))
+        
+        plays = [list(self.path(start_spot, endpoint, move_tree)) for start_spot, endpoint, move_tree in max_pool]
+        return self.choose_best(np.full(len(plays), best), plays)
 
 
 class RandomSingleMovePlayer(Player):
     def play(self):
         game = self.game
-        start_spot = game.player_spots[self.name][np.random.choice(game.pieces_per_player)]
-        legal_moves = game.get_legal_moves(self.name, start_spot)
+        piece = np.random.choice(game.pieces_per_player)
+        start_spot = game.player_spots[self.name][piece]
+        _, endpoints, _ = game.first_moves(self.name, [piece])
+        legal_moves = [game.board.board_spots[endpoint] for endpoint in endpoints]
         while True:
-            endpoint, move_state = random.choice(legal_moves)
+            endpoint = random.choice(legal_moves)
             if game.is_legal_endpoint(self.name, start_spot, endpoint):
                 return [start_spot, endpoint]
 
 
-class RandomPlayer(Player, DepthFirstMoveFinderMixin):
+class RandomPlayer(DepthFirstMoveFinderMixin, Player):
     def play(self):
-        return random.choice([move] for _, move in self.moves())
+        return random.choice([move for _, move in self.moves()])
 
 
 class SingleMoveProgressMaximizer(BaseProgressTracker):
     """Picks a sequence consisting of the single move that increases the score the most"""
     def moves(self):
+        # The moves of all the pieces are found at once
+        first_moves = self.game.first_moves_by_piece(self.name)
+        
+        found_any = False
         for i in range(self.game.pieces_per_player):
-            yield from self.moves_for_piece(self.game.player_spots[self.name][i])
+            # Out of time: settle for the plays found so far
+            if found_any and self.game.deadline.expired():
+                return
+            for progress, play in self.moves_for_piece(self.game.player_spots[self.name][i], first_moves[i]):
+                found_any = True
+                yield progress, play
 
-    def moves_for_piece(self, start_spot):
+    def moves_for_piece(self, start_spot, legal_moves=None):
         game = self.game
         board = self.game.board
         progress_before = board.progress_function[self.name](start_spot)
-        legal_moves = game.get_legal_moves(self.name, start_spot)
+        if legal_moves is None:
+            legal_moves = game.get_legal_moves(self.name, start_spot)
         for move, move_state in legal_moves:
             if game.is_legal_endpoint(self.name, start_spot, move):
                 progress = board.progress_function[self.name](move) - progress_before
                 yield progress, [start_spot, move]
 
+class ResponseCache(object):
+    """Bounded mapping from (opponent, position) to the play the opponent made there.
+    The least recently used entries are evicted first.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        play = self.entries.get(key)
+        if play is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return play
+
+    def put(self, key, play):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = play
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
 class PlanningProgressMaximizer(BaseProgressTracker):
+    """Looks max_play_depth plays ahead, letting the opponent models (or cheap_opponent_class
+    from cheap_opponent_depth on) respond to each play"""
     def __init__(self, name, game, params=None):
         super().__init__(name, game, params)
-        self.move_finder = NonPlanningProgressMaximizer(name, game, { 'max_depth': params['max_depth'] })
+        self.move_finder = NonPlanningProgressMaximizer(name, game, {
+            'max_depth': params['max_depth'],
+            'search_pool': params.get('search_pool'),
+        })
         self.opponent_models = params.get('opponent_models', [])
+        self.opponent_cache = ResponseCache(params.get('opponent_cache_size', 10000))
+        self.cheap_opponent_class = params.get('cheap_opponent_class')
+        self.cheap_opponent_params = params.get('cheap_opponent_params', {})
+        self.cheap_opponent_depth = params.get('cheap_opponent_depth', 1)
+        self.cheap_opponent_models = None
+
+    def opponents_at(self, depth):
+        """Returns the opponent models to use at the given depth"""
+        if self.cheap_opponent_class is None or depth < self.cheap_opponent_depth:
+            return self.opponent_models
+        if self.cheap_opponent_models is None:
+            self.cheap_opponent_models = [
+                self.cheap_opponent_class(opponent.name, self.game, self.cheap_opponent_params)
+                for opponent in self.opponent_models
+            ]
+        return self.cheap_opponent_models
+
+    def opponent_play(self, opponent):
+        """Returns the opponent's play in the current position, from the cache if possible"""
+        key = (opponent, self.game.position())
+        play = self.opponent_cache.get(key)
+        if play is None:
+            play = opponent.play()
+            self.opponent_cache.put(key, play)
+        return play
 
     def pop_n(self, n):
         for i in range(n):
             self.game.pop_move()
         
     def explore_consequences(self, depth, explored_positions, move=None):
-        if depth == self.params['max_play_depth']:
+        # Out of time: treat this as a leaf, so that the plays explored so far can be compared
+        if depth == self.params['max_play_depth'] or (depth > 0 and self.game.deadline.expired()):
             yield self.total_progress(), move
             return
 
-        # Get the heap of moves
-        heap = self.move_finder.build_heap()
-        for i in range(min(self.params['fanout'], len(heap))):
-            n_pushes = 0
-            m_progress, play = heapq.heappop(heap)
+        # Get the best moves
+        plays = self.move_finder.top_k(self.params['fanout'])
+        
+        # The plays from the root can be explored in parallel if there is a search pool
+        search_pool = self.params.get('search_pool')
+        if depth == 0 and search_pool is not None:
+            explore_play = search_pool.play_explorer(self, plays, explored_positions)
+        else:
+            explore_play = self.explore_play
+        
+        found_any = False
+        for play in plays:
+            # Out of time: settle for the plays found so far
+            if found_any and self.game.deadline.expired():
+                break
             
             # At depth=0, we consider every move. At depth > 0, we only consider the top-level move
             if depth == 0:
                 move = play
             
-            # Only need to consider the start and end point
-            start = play[0]
-            end = play[-1]
-            
-            # Fake-play the move
-            self.game.push_move(self.name, start, end, MoveState.ALREADY_CHECKED)
-            n_pushes += 1
+            seen, mean_progress = explore_play(depth, explored_positions, play, move)
             
             # If this position has been explored already, don't explore further
-            position = frozenset(self.positions())
-            if position in explored_positions:
-                self.pop_n(n_pushes)
+            if seen:
                 break
-            explored_positions.add(position)
-            
-            # Let the opponents move
-            for opponent in self.opponent_models:
-                opponent_move = opponent.play()
-                opponent_start = opponent_move[0]
-                opponent_end = opponent_move[-1]
-                self.game.push_move(self.name, opponent_start, opponent_end, MoveState.ALREADY_CHECKED)
-                n_pushes += 1
-            
-            # Check the expected total progress after doing the move
-            sum_progress = 0
-            n_moves = 0
-            for total_progress, _move in self.explore_consequences(depth + 1, explored_positions, move):
-                sum_progress += total_progress
-                n_moves += 1
             
             # If there were no possible moves, just continue
-            if n_moves == 0:
-                self.pop_n(n_pushes)
+            if mean_progress is None:
                 continue
             
             # Yield the mean progress for the move
-            yield sum_progress / n_moves, move
+            found_any = True
+            yield mean_progress, move
+    
+    def explore_play(self, depth, explored_positions, play, move):
+        """Fake-plays the play and the opponents' responses, and explores the consequences.
+        Returns whether the position after the play was explored already, and the mean total progress
+        over the consequences (None if there were none).
+        """
+        # Only need to consider the start and end point
+        self.game.push_move(self.name, play[0], play[-1], MoveState.ALREADY_CHECKED)
+        n_pushes = 1
+        
+        position = frozenset(self.positions())
+        if position in explored_positions:
             self.pop_n(n_pushes)
+            return True, None
+        explored_positions.add(position)
+        
+        # The move finder forgets the hypothetical positions it sees in this line afterwards,
+        # so that they do not leak into the other lines or into the next play
+        memory = self.move_finder.explored_positions.copy()
+        
+        # Let the opponents move
+        for opponent in self.opponents_at(depth):
+            opponent_move = self.opponent_play(opponent)
+            opponent_start = opponent_move[0]
+            opponent_end = opponent_move[-1]
+            self.game.push_move(opponent.name, opponent_start, opponent_end, MoveState.ALREADY_CHECKED)
+            n_pushes += 1
+        
+        # Check the expected total progress after doing the move
+        sum_progress = 0
+        n_moves = 0
+        for total_progress, _move in self.explore_consequences(depth + 1, explored_positions, move):
+            sum_progress += total_progress
+            n_moves += 1
+        self.pop_n(n_pushes)
+        self.move_finder.explored_positions = memory
+        
+        if n_moves == 0:
+            return False, None
+        return False, sum_progress / n_moves
     
     def moves(self):
         explored_positions = set()
         explored_positions.add(frozenset(self.positions()))
         for total_progress, move in self.explore_consequences(0, explored_positions):
-            yield total_progress, move
\ No newline at end of file
+            yield total_progress, move
+
+
+class BeamSearchPlayer(PlanningProgressMaximizer):
+    """Looks max_play_depth plays ahead, keeping only the beam_width best lines of plays and responses at each depth"""
+    def __init__(self, name, game, params=None):
+        super().__init__(name, game, params)
+        self.beam_width = params.get('beam_width', 4)
+        
+        # The candidate plays are scored by the same evaluator as the lines
+        self.move_finder = NonPlanningProgressMaximizer(name, game, {
+            'max_depth': params['max_depth'],
+            'search_pool': params.get('search_pool'),
+            'evaluator': self.evaluator,
+        })
+
+    def moves(self):
+        game = self.game
+        
+        # A line is (score, first play, the moves from the root)
+        beam = [(0.0, None, [])]
+        memory = self.move_finder.explored_positions.copy()
+        for depth in range(self.params['max_play_depth']):
+            # Out of time: settle for the lines found so far
+            if depth > 0 and game.deadline.expired():
+                break
+            
+            lines = {}
+            for score, first_play, moves in beam:
+                for move in moves:
+                    game.push_move(*move)
+                for play_score, play in self.move_finder.scored_top_k(self.params['fanout']):
+                    line_moves = [(self.name, play[0], play[-1], MoveState.ALREADY_CHECKED)]
+                    game.push_move(*line_moves[0])
+                    
+                    # Let the opponents move
+                    for opponent in self.opponents_at(depth):
+                        opponent_move = self.opponent_play(opponent)
+                        line_moves.append((opponent.name, opponent_move[0], opponent_move[-1], MoveState.ALREADY_CHECKED))
+                        game.push_move(*line_moves[-1])
+                    
+                    # Keep the best line to each position
+                    position = game.position()
+                    line = (score + play_score, first_play or play, moves + line_moves)
+                    if position not in lines or line[0] > lines[position][0]:
+                        lines[position] = line
+                    self.pop_n(len(line_moves))
+                self.pop_n(len(moves))
+                
+                # The move finder forgets the hypothetical positions it has seen
+                self.move_finder.explored_positions = memory.copy()
+            
+            if not lines:
+                break
+            beam = heapq.nlargest(self.beam_width, lines.values(), key=lambda line: line[0])
+        
+        # Score each play from the root by its best line
+        best = {}
+        for score, first_play, _ in beam:
+            if first_play is not None:
+                key = tuple(first_play)
+                best[key] = max(score, best.get(key, score))
+        for play, score in best.items():
+            yield score, list(play)
+
+    def evaluate(self):
+        """Scores each play from the root by its best line. The line scores are already the evaluator's
+        scores, so they are not passed through the evaluator again."""
+        scores = []
+        plays = []
+        for score, play in self.moves():
+            scores.append(score)
+            plays.append(play)
+        return np.array(scores, dtype=float), plays
+
@@ -0,0 +1,387 @@
+from itertools import combinations
+import multiprocessing
+from queue import Full
+import weakref
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+from coordinate_transformer import CoordinateTransformer
+from game import Game
+from hooks import GameHooks
+import plotlib
+
+
+class BoardPlotter(object):
+    def __init__(self, board, transformer):
+        self.board = board
+        self.transformer = transformer
+    
+    def plot_transformed(self, in_vectors, newfig=True, text=False, **kwargs):
+        if newfig:
+            mpl.style.use("default")
+            plt.figure(figsize=(7, 7))
+        
+        transformed = self.transformer(np.array(in_vectors))
+        
+        if text:
+            for (xh, yh, zh), (x, y) in zip(in_vectors, transformed):
+                plt.text(x, y, "[{},{},{}]".format(xh, yh, zh), fontsize=7)
+        
+        if len(transformed) > 0:
+            alpha = kwargs.pop('alpha', 0.3)
+            plt.scatter(*transformed.T, alpha=alpha, **kwargs)
+        plotlib.geom_plot(xticks=[], yticks=[], xlabel="", ylabel="")
+    
+    def plot_spots(self, text=False, **kwargs):
+        newfig = kwargs.pop('newfig', False)
+        self.show_spots(self.board.field_spots, newfig=newfig, color="lightgreen", text=text, **kwargs)
+        for color, spots in self.board.color_spots.items():
+            self.show_spots(spots, newfig=False, color=color, text=text, **kwargs)
+    
+    def plot_move(self, vec_in, vec_out, curved=True, **kwargs):
+        plotlib.arrow(self.transformer(vec_in), self.transformer(vec_out), curved, **kwargs)
+    
+    def show_spots(self, spots, **kwargs):
+        self.plot_transformed(spots, **kwargs)
+
+
+class GamePlotter(object):
+    def __init__(self, game, transformer):
+        self.board_plotter = BoardPlotter(game.board, transformer)
+        self.game = game
+        self.figure = None
+    
+    def plot(self, text=False):
+        self.board_plotter.plot_spots(text)
+        for color, spots in self.game.player_spots.items():
+            self.board_plotter.show_spots(spots, newfig=False, color=color, s=100)   
+
+    def init_artists(self, text=False):
+        """Draws the board in a new figure, and creates the artists that change from play to play.
+        After this, use update_pieces, add_move and clear_moves followed by blit or savefig
+        to show the game instead of plotting everything again.
+        """
+        mpl.style.use("default")
+        self.figure = plt.figure(figsize=(7, 7))
+        self.axes = self.figure.gca()
+        self.board_plotter.plot_spots(text)
+        self.piece_artists = {
+            color: self.axes.scatter(*self.transformer(np.array(spots)).T, color=color, s=100, alpha=0.3, animated=True)
+            for color, spots in self.game.player_spots.items()
+        }
+        self.move_artists = []
+        self.background = None
+        self.figure.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def update_pieces(self, positions=None):
+        """Moves the pieces to the given positions (by default, the current positions in the game)"""
+        if positions is None:
+            positions = self.game.player_spots
+        for color, spots in positions.items():
+            self.piece_artists[color].set_offsets(self.transformer(np.array(spots)))
+
+    def add_move(self, vec_in, vec_out):
+        arrow = plotlib.mkarrow(self.transformer(np.array(vec_in)), self.transformer(np.array(vec_out)), True)
+        arrow.set_animated(True)
+        self.axes.add_patch(arrow)
+        self.move_artists.append(arrow)
+
+    def clear_moves(self):
+        for arrow in self.move_artists:
+            arrow.remove()
+        self.move_artists = []
+
+    def on_draw(self, event):
+        # The figure was fully redrawn (e.g. resized), so the background must be captured again
+        self.background = self.figure.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for artist in self.piece_artists.values():
+            self.axes.draw_artist(artist)
+        for artist in self.move_artists:
+            self.axes.draw_artist(artist)
+
+    def blit(self):
+        """Redraws only the pieces and moves on top of the static board"""
+        canvas = self.figure.canvas
+        if self.background is None:
+            canvas.draw()
+        else:
+            canvas.restore_region(self.background)
+            self.draw_animated()
+        canvas.blit(self.axes.bbox)
+        canvas.flush_events()
+
+    def savefig(self, fname):
+        self.figure.savefig(fname)
+
+    def __getattr__(self, attr):
+        return getattr(self.board_plotter, attr)
+
+
+class ResultPlotter(object):
+    def __init__(self, simulator):
+        self.simulator = simulator
+    
+    def get_dists(self):
+        return self.simulator.results.dists(self.simulator.player_colors)
+
+    def get_win_matrix(self):
+        return self.simulator.results.win_matrix(self.simulator.player_colors)
+
+    def plot_distributions(self):
+        plt.figure(figsize=(7, 7))
+        dists = self.get_dists()
+        for color, dist in dists.items():
+            plt.hist(
+                dist, 
+                alpha=0.8,
+                color=color,
+                bins=15
+            )
+        plt.xlabel("Number of moves")
+        plt.ylabel("Density")
+        plt.title("Distribution of game lengths")
+        plt.show()
+    
+    def plot_correlations(self):
+        dists = self.get_dists()
+        for color_x, color_y in combinations(self.simulator.player_colors, 2):
+            plt.figure(figsize=(7, 7))
+            dist_x = dists[color_x]
+            dist_y = dists[color_y]
+            min_ = min(dist_x.min(), dist_y.min())
+            max_ = max(dist_x.max(), dist_y.max())
+            tied = dist_x == dist_y
+            untied = ~tied
+            colors = np.where(dist_x[untied] < dist_y[untied], color_x, color_y)
+
+            plt.scatter(dist_x[untied], dist_y[untied], alpha=0.5, color=colors)
+            if np.any(tied):
+                plt.scatter(dist_x[tied], dist_y[tied], marker="x")
+            plt.xlabel("#moves by {}".format(color_x))
+            plt.ylabel("#moves by {}".format(color_y))
+            plt.xlim(min_ - 1, max_ + 1)
+            plt.ylim(min_ - 1, max_ + 1)
+            plt.title("Matchup: {} vs. {}".format(color_x, color_y))
+            plt.axis("equal")
+            plt.show()
+
+    def plot_win_matrix(self):
+        colors = self.simulator.player_colors
+        plt.figure(figsize=(7, 7))
+        plt.imshow(self.get_win_matrix(), cmap="viridis")
+        plt.colorbar()
+        plt.xticks(range(len(colors)), colors)
+        plt.yticks(range(len(colors)), colors)
+        plt.xlabel("Finished later")
+        plt.ylabel("Finished earlier")
+        plt.title("Pairwise wins")
+        plt.show()
+
+    def plot_progress(self, store=None):
+        """Plots the mean progress curve of every color, with the 10th-90th percentile band.
+        Progress curves are recorded by ProgressTrackerHooks, so pass its store
+        unless it was created with the simulator's store.
+        """
+        store = store if store is not None else self.simulator.results
+        plt.figure(figsize=(7, 7))
+        for color in self.simulator.player_colors:
+            curves = store.progress_curves(color)
+            if curves.size == 0:
+                continue
+            plays = np.arange(curves.shape[1])
+            plt.plot(plays, np.nanmean(curves, axis=0), color=color, label=color)
+            plt.fill_between(
+                plays,
+                np.nanpercentile(curves, 10, axis=0),
+                np.nanpercentile(curves, 90, axis=0),
+                color=color,
+                alpha=0.2
+            )
+        plt.xlabel("Moves")
+        plt.ylabel("Progress")
+        plt.legend()
+        plt.show()
+
+
+# Transformation from hex coordinates to the plane
+HEX_TO_RECT = np.array([
+    [    1,            0 ],
+    [ -1/2, np.sqrt(3)/2 ],
+    [  1/2, np.sqrt(3)/2 ],
+])
+
+
+class PlotHooks(GameHooks):
+    def __init__(self,
+                 transform=HEX_TO_RECT,
+                 fig_format="hexgrid-figures/tree-{}.png",
+                 save_fig=False):
+        self.transform = transform
+        self.save_fig = save_fig
+        self.fig_format = fig_format
+
+    def before_game(self, game):
+        self.play_counter = 0
+        
+        self.plotter = GamePlotter(
+            game,
+            transformer=CoordinateTransformer(
+                transform=np.array(self.transform)
+            )
+        )
+        
+        # The board is drawn once, after that only the pieces and the moves are updated
+        self.plotter.init_artists(text=True)
+        if not self.save_fig:
+            plt.show(block=False)
+    
+    def after_move(self, start, end):
+        self.plotter.add_move(start, end)
+
+    def before_play(self, *_):
+        self.plotter.clear_moves()
+        self.plotter.update_pieces()
+        
+    def after_play(self, *_):
+        self.play_counter += 1
+        
+        if self.save_fig:
+            self.plotter.savefig(self.fig_format.format(self.play_counter))
+        else:
+            self.plotter.blit()
+
+    def after_game(self):
+        if self.save_fig:
+            plt.close(self.plotter.figure)
+
+
+def render_frames(queue, transform, fig_format, animation_path=None, frame_duration=200):
+    """Renders the games put on the queue by BackgroundPlotHooks until it receives None"""
+    plt.switch_backend("Agg")
+    plotter = None
+    board = None
+    frames = []
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        if message[0] == 'game':
+            _, game_index, colors, n = message
+            frames = []
+
+            # The figure is only set up again when the board or the colors change
+            if (colors, n) != board:
+                if plotter is not None:
+                    plt.close(plotter.figure)
+                plotter = GamePlotter(Game(colors, n), transformer=CoordinateTransformer(transform=np.array(transform)))
+                plotter.init_artists()
+                board = (colors, n)
+        elif message[0] == 'play':
+            _, play_counter, positions, moves = message
+
+            # Draw the position before the play, with the path the piece took
+            plotter.clear_moves()
+            plotter.update_pieces(positions)
+            for start, end in zip(moves[:-1], moves[1:]):
+                plotter.add_move(start, end)
+
+            frame = fig_format.format(game_index, play_counter)
+            plotter.savefig(frame)
+            frames.append(frame)
+        elif message[0] == 'end' and animation_path and frames:
+            images = [Image.open(frame) for frame in frames]
+            images[0].save(animation_path.format(game_index), save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
+    if plotter is not None:
+        plt.close(plotter.figure)
+
+
+def stop_renderer(queue, worker):
+    """Lets the renderer finish the frames in the queue, if it is still alive"""
+    if worker.is_alive():
+        queue.put(None)
+    worker.join()
+
+
+class BackgroundPlotHooks(GameHooks):
+    """Like PlotHooks with save_fig=True, but the frames of every game are rendered by one separate process.
+    fig_format gets the game index and the play number, animation_path the game index; call close at the end of the run.
+    """
+    def __init__(self,
+                 transform=HEX_TO_RECT,
+                 fig_format="hexgrid-figures/game-{}-tree-{}.png",
+                 max_queue=16,
+                 animation_path=None,
+                 frame_duration=200,
+                 put_timeout=1.0):
+        self.transform = transform
+        self.fig_format = fig_format
+        self.max_queue = max_queue
+        self.animation_path = animation_path
+        self.frame_duration = frame_duration
+        self.put_timeout = put_timeout
+        self.game_index = -1
+        self.worker = None
+
+    def start(self):
+        self.queue = multiprocessing.Queue(maxsize=self.max_queue)
+        self.worker = multiprocessing.Process(
+            target=render_frames,
+            args=(self.queue, self.transform, self.fig_format, self.animation_path, self.frame_duration),
+            daemon=True,
+        )
+        self.worker.start()
+
+        # The frames that are left are still rendered if the hooks are never closed
+        self.finalizer = weakref.finalize(self, stop_renderer, self.queue, self.worker)
+
+    def before_game(self, game):
+        if self.worker is None:
+            self.start()
+        self.play_counter = 0
+        self.game = game
+        self.game_index = game.game_id if game.game_id is not None else self.game_index + 1
+        self.put(('game', self.game_index, list(game.player_spots), game.board.n))
+
+    def before_play(self, *_):
+        self.positions = {
+            color: spots.copy()
+            for color, spots in self.game.player_spots.items()
+        }
+
+    def after_play(self, color, player, moves):
+        self.play_counter += 1
+        self.put(('play', self.play_counter, self.positions, list(moves)))
+
+    def after_game(self):
+        self.put(('end',))
+
+    def put(self, message):
+        """Waits for room in the queue for as long as the renderer is alive"""
+        while True:
+            if not self.worker.is_alive():
+                raise RuntimeError("The frame renderer exited with code {}".format(self.worker.exitcode))
+            try:
+                self.queue.put(message, timeout=self.put_timeout)
+                return
+            except Full:
+                pass
+
+    def close(self):
+        """Waits for the renderer to finish the frames that are left in the queue"""
+        if self.worker is None:
+            return
+        worker = self.worker
+        self.finalizer.detach()
+        try:
+            self.put(None)
+            worker.join()
+        finally:
+            self.worker = None
+        if worker.exitcode:
+            raise RuntimeError("The frame renderer exited with code {}".format(worker.exitcode))
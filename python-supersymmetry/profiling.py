@@ -0,0 +1,237 @@
+from collections import Counter
+import os
+import signal
+import sys
+import threading
+import time
+
+
+# Functions in the engine, by the phase they belong to.
+# A stack is attributed to the phase of its innermost function that is listed here.
+LEGALITY = {'is_legal_move', 'is_legal_ray_move', 'is_legal_endpoint', 'get_line', 'occupation', 'occupied'}
+MOVE_GENERATION = {'get_legal_moves', 'get_legal_ray_moves', 'line_moves', 'first_moves', 'first_moves_by_piece', 'moves', 'move_tree', 'explore', 'moves_for_piece', 'path', 'legal_plays', 'reachable'}
+SEARCH = {
+    'play', 'evaluate', 'explore_consequences', 'opponents_at', 'opponent_play',
+    'top_k', 'scored_top_k', 'choose_best', 'build_heap', 'choose', 'branch_and_bound',
+}
+ENGINE_FILES = {'game.py', 'players.py', 'perft.py'}
+
+# Functions that Game.run calls that are not hooks
+GAME_CALLS = {'play', 'do_move', 'win_condition', 'start_play', 'end_play', 'start_game', 'compile'}
+
+PHASES = ('move generation', 'legality', 'search', 'hooks', 'other')
+
+
+def frame_label(code):
+    """Returns the label of a function in a stack, as file:qualified name"""
+    return "{}:{}".format(os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+def phase_of(stack):
+    """Returns the engine phase that a stack of frame labels belongs to"""
+    # Everything that is called by a hook is part of the hook
+    for caller, callee in zip(stack, stack[1:]):
+        if caller == "game.py:Game.run":
+            filename, _, name = callee.partition(":")
+            name = name.rpartition(".")[2]
+            if filename not in ('~', 'game.py', 'timecontrol.py') and name not in GAME_CALLS:
+                return 'hooks'
+
+    for label in reversed(stack):
+        filename, _, name = label.partition(":")
+        name = name.rpartition(".")[2]
+        if filename == 'evaluation.py':
+            return 'search'
+        if filename not in ENGINE_FILES:
+            continue
+        if name in LEGALITY:
+            return 'legality'
+        if name in MOVE_GENERATION:
+            return 'move generation'
+        if name in SEARCH:
+            return 'search'
+    return 'other'
+
+
+class StackTracer(object):
+    """A profile function that records the time spent in every stack of calls, in seconds.
+    Every call is recorded, so the stacks are exact but the code runs several times slower.
+    """
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.path = [()]
+        self.last = time.perf_counter()
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        path = self.path[-1]
+        if path:
+            self.stacks[path] += now - self.last
+        if event == 'call':
+            self.path.append(path + (frame_label(frame.f_code),))
+        elif event == 'c_call':
+            self.path.append(path + ("~:" + getattr(arg, '__qualname__', repr(arg)),))
+        elif len(self.path) > 1:
+            # return, c_return or c_exception
+            self.path.pop()
+        self.last = time.perf_counter()
+
+
+def stack_below(frame, root):
+    """Returns the labels of the frames from just below root to frame, or None if root is not in the stack"""
+    labels = []
+    while frame is not None and frame is not root:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    if frame is None or not labels:
+        return None
+    return tuple(reversed(labels))
+
+
+class SignalSampler(object):
+    """Samples the stack of the main thread below the root frame from a SIGPROF handler,
+    every interval seconds of CPU time. Each sample is weighted by the time since the previous sample.
+    """
+    def __init__(self, stacks, root, interval):
+        self.stacks = stacks
+        self.root = root
+        self.interval = interval
+
+    def sample(self, signum, frame):
+        now = time.perf_counter()
+        stack = stack_below(frame, self.root)
+        if stack is not None:
+            self.stacks[stack] += now - self.last
+        self.last = now
+
+    def start(self):
+        self.last = time.perf_counter()
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+
+class ThreadSampler(threading.Thread):
+    """Samples the stack of a thread below the root frame from another thread, every interval seconds.
+    Used where there are no profiling signals. The sampler only runs when the sampled thread
+    releases the GIL, so the samples are biased towards code that calls into C.
+    """
+    def __init__(self, stacks, root, interval):
+        super().__init__(daemon=True)
+        self.stacks = stacks
+        self.thread_id = threading.get_ident()
+        self.root = root
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            stack = stack_below(sys._current_frames().get(self.thread_id), self.root)
+            now = time.perf_counter()
+            if stack is not None:
+                self.stacks[stack] += now - last
+            last = now
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class SimulationProfiler(object):
+    """Profiles a subset of the games played by a Simulator.
+
+    In 'sample' mode, the stack of the game is sampled every interval seconds of CPU time, which barely slows the game down.
+    In 'trace' mode, every call is traced, which is exact but slow.
+    games is either None to profile every game, an int k to profile every k-th game, or a collection of game ids.
+
+    Only the code that runs inside the profiled games is recorded, and every stack is attributed to
+    one of PHASES. The stacks can be written in the collapsed format that flamegraph tools read.
+    """
+    def __init__(self, mode='sample', games=None, interval=0.001):
+        if mode not in ('sample', 'trace'):
+            raise ValueError("Unknown profiling mode {!r}".format(mode))
+        self.mode = mode
+        self.games = games
+        self.interval = interval
+        self.stacks = Counter()
+        self.n_games = 0
+
+    def selected(self, game_id):
+        if self.games is None:
+            return True
+        if isinstance(self.games, int):
+            return game_id % self.games == 0
+        return game_id in self.games
+
+    def run(self, game_id, func, *args):
+        """Calls func(*args), and profiles the call if the game is selected"""
+        if not self.selected(game_id):
+            return func(*args)
+        self.n_games += 1
+
+        if self.mode == 'trace':
+            previous = sys.getprofile()
+            sys.setprofile(StackTracer(self.stacks))
+            try:
+                return func(*args)
+            finally:
+                sys.setprofile(previous)
+
+        if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+            sampler = SignalSampler(self.stacks, sys._getframe(), self.interval)
+        else:
+            sampler = ThreadSampler(self.stacks, sys._getframe(), self.interval)
+        sampler.start()
+        try:
+            return func(*args)
+        finally:
+            sampler.stop()
+
+    def take(self):
+        """Returns the stacks recorded so far and forgets them"""
+        stacks, self.stacks = self.stacks, Counter()
+        n_games, self.n_games = self.n_games, 0
+        return stacks, n_games
+
+    def merge(self, profile):
+        """Adds stacks returned by take, e.g. from the profiler in a worker process"""
+        stacks, n_games = profile
+        self.stacks.update(stacks)
+        self.n_games += n_games
+
+    @property
+    def total(self):
+        return sum(self.stacks.values())
+
+    def phases(self):
+        """Returns the seconds spent in each phase"""
+        seconds = dict.fromkeys(PHASES, 0.0)
+        for stack, weight in self.stacks.items():
+            seconds[phase_of(stack)] += weight
+        return seconds
+
+    def collapsed(self):
+        """Returns the stacks as lines of semicolon-separated frames followed by microseconds, rooted at their phase"""
+        lines = []
+        for stack, weight in sorted(self.stacks.items()):
+            microseconds = int(round(weight * 1e6))
+            if microseconds:
+                lines.append("{};{} {}".format(phase_of(stack), ";".join(stack), microseconds))
+        return lines
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+
+    def report(self):
+        """Returns a summary of the time spent in each phase"""
+        total = self.total
+        lines = ["{} games profiled ({}), {:.3f} s".format(self.n_games, self.mode, total)]
+        for phase, seconds in self.phases().items():
+            lines.append("  {:<16} {:8.3f} s {:6.1%}".format(phase, seconds, seconds / total if total else 0.0))
+        return "\n".join(lines)
@@ -0,0 +1,191 @@
+import numpy as np
+
+
+def match_score(win_sequence, color):
+    """Returns the fraction of the opponents that the color finished before (ties count as half)"""
+    steps = dict(win_sequence)
+    others = [step for color_, step in steps.items() if color_ != color]
+    return sum(1.0 if steps[color] < step else 0.5 if steps[color] == step else 0.0 for step in others) / len(others)
+
+
+class GrowableArray(object):
+    """A preallocated NumPy structured array that grows geometrically when it runs out of room"""
+    def __init__(self, dtype, capacity=1024, growth=2):
+        self.dtype = np.dtype(dtype)
+        self.growth = growth
+        self.size = 0
+        self.buffer = np.zeros(capacity, dtype=self.dtype)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def data(self):
+        """A view of the rows that have been written so far"""
+        return self.buffer[:self.size]
+
+    def reserve(self, extra):
+        """Makes sure that `extra` more rows fit without reallocating"""
+        needed = self.size + extra
+        if needed <= len(self.buffer):
+            return
+        capacity = max(len(self.buffer), 1)
+        while capacity < needed:
+            capacity *= self.growth
+        buffer = np.zeros(capacity, dtype=self.dtype)
+        buffer[:self.size] = self.data
+        self.buffer = buffer
+
+    def append(self, row):
+        self.reserve(1)
+        self.buffer[self.size] = row
+        self.size += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        self.reserve(len(rows))
+        self.buffer[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def clear(self):
+        self.size = 0
+
+
+class ResultStore(object):
+    """Columnar storage of simulation results.
+
+    Finishing steps are stored as one row per (game, color), and progress curves as
+    one row per (game, color, play). All the aggregations are vectorized queries over these arrays.
+    """
+    FINISH_DTYPE = np.dtype([
+        ('game', np.int64),
+        ('color', np.int8),
+        ('step', np.int32),
+    ])
+    PROGRESS_DTYPE = np.dtype([
+        ('game', np.int64),
+        ('color', np.int8),
+        ('play', np.int32),
+        ('progress', np.float64),
+    ])
+
+    def __init__(self, colors=(), capacity=1024):
+        self.colors = []
+        self.color_indices = {}
+        for color in colors:
+            self.color_index(color)
+        self.finishes = GrowableArray(self.FINISH_DTYPE, capacity)
+        self.progress = GrowableArray(self.PROGRESS_DTYPE, capacity)
+        self.n_games = 0
+
+    def save(self, path, **extra):
+        """Saves the results, along with any extra arrays, to a .npz file"""
+        np.savez(
+            path,
+            colors=np.array(self.colors, dtype=str),
+            n_games=self.n_games,
+            finishes=self.finishes.data,
+            progress=self.progress.data,
+            **extra
+        )
+
+    @classmethod
+    def load(cls, path):
+        return cls().read(path)
+
+    def read(self, path):
+        """Replaces the results with the ones saved at path, in place, so that hooks writing to this store keep working"""
+        with np.load(path) as data:
+            self.colors = []
+            self.color_indices = {}
+            for color in data['colors'].tolist():
+                self.color_index(color)
+            self.n_games = int(data['n_games'])
+            self.finishes.clear()
+            self.finishes.extend(data['finishes'])
+            self.progress.clear()
+            self.progress.extend(data['progress'])
+        return self
+
+    def color_index(self, color):
+        """Returns the index used for the color in the arrays, assigning a new one if it is unknown"""
+        if color not in self.color_indices:
+            self.color_indices[color] = len(self.colors)
+            self.colors.append(color)
+        return self.color_indices[color]
+
+    def add_game(self, win_sequence, game_id=None):
+        """Stores the win sequence returned by Game.run and returns the game id"""
+        if game_id is None:
+            game_id = self.n_games
+        self.n_games = max(self.n_games, game_id + 1)
+        self.finishes.extend([
+            (game_id, self.color_index(color), step)
+            for color, step in win_sequence
+        ])
+        return game_id
+
+    def add_progress(self, game_id, color, play, progress):
+        self.n_games = max(self.n_games, game_id + 1)
+        self.progress.append((game_id, self.color_index(color), play, progress))
+
+    def finishing_steps(self, colors=None):
+        """Returns an (n_games, n_colors) array with the step at which each color finished.
+        Entries are -1 where the color did not take part in the game.
+        """
+        colors = self.colors if colors is None else colors
+        steps = np.full((self.n_games, len(colors)), -1, dtype=np.int32)
+        lookup = np.full(len(self.colors), -1, dtype=np.int64)
+        for i, color in enumerate(colors):
+            if color in self.color_indices:
+                lookup[self.color_indices[color]] = i
+        data = self.finishes.data
+        columns = lookup[data['color']]
+        keep = columns >= 0
+        steps[data['game'][keep], columns[keep]] = data['step'][keep]
+        return steps
+
+    def dists(self, colors=None):
+        """Returns a mapping from color to the finishing steps of the games it took part in"""
+        colors = self.colors if colors is None else colors
+        steps = self.finishing_steps(colors)
+        return {
+            color: steps[steps[:, i] >= 0, i]
+            for i, color in enumerate(colors)
+        }
+
+    def win_matrix(self, colors=None):
+        """Returns a matrix where entry (i, j) counts the games in which color i finished before color j"""
+        colors = self.colors if colors is None else colors
+        steps = self.finishing_steps(colors)
+        played = steps >= 0
+        both = played[:, :, None] & played[:, None, :]
+        earlier = steps[:, :, None] < steps[:, None, :]
+        return np.sum(both & earlier, axis=0)
+
+    def progress_curves(self, color):
+        """Returns an (n_games, n_plays) array with the progress of the color after every play.
+        Entries are NaN after the color stopped playing.
+        """
+        data = self.progress.data
+        data = data[data['color'] == self.color_indices.get(color, -1)]
+        n_plays = data['play'].max() + 1 if len(data) else 0
+        curves = np.full((self.n_games, n_plays), np.nan)
+        curves[data['game'], data['play']] = data['progress']
+        return curves
+
+    def winners(self):
+        """Returns the results in the same format as the win sequences returned by Game.run"""
+        data = self.finishes.data
+        sequences = [[] for _ in range(self.n_games)]
+        for game_id, color, step in zip(data['game'].tolist(), data['color'].tolist(), data['step'].tolist()):
+            sequences[game_id].append((self.colors[color], step))
+        return sequences
+
+    def progress_dicts(self):
+        """Returns the progress curves as a list with one {color: [progress, ...]} mapping per game"""
+        data = self.progress.data
+        games = [{} for _ in range(self.n_games)]
+        for game_id, color, progress in zip(data['game'].tolist(), data['color'].tolist(), data['progress'].tolist()):
+            games[game_id].setdefault(self.colors[color], []).append(progress)
+        return games
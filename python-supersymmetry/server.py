@@ -0,0 +1,456 @@
+"""A long-running HTTP server that lets the bots in players.py play for the web client.
+Run it with python server.py --port 8765 --allow-origin http://localhost:3000.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from evaluation import LinearEvaluator
+from game import Game, MoveState
+import players
+from state import board_for
+from timecontrol import Deadline, NO_DEADLINE
+
+
+# The player classes a client can ask for, with the params each of them needs
+PLAYER_CLASSES = {
+    player_class.__name__: (player_class, required)
+    for player_class, required in (
+        (players.RandomSingleMovePlayer, ()),
+        (players.RandomPlayer, ('max_depth',)),
+        (players.SingleMoveProgressMaximizer, ()),
+        (players.NonPlanningProgressMaximizer, ('max_depth',)),
+        (players.PlanningProgressMaximizer, ('max_depth', 'max_play_depth', 'fanout')),
+        (players.BeamSearchPlayer, ('max_depth', 'max_play_depth', 'fanout')),
+    )
+}
+
+# The integer player params a client can give, with the smallest and largest values allowed.
+# Params that name files (opening_book) or objects in the server (search_pool, opponent_models) are refused.
+PLAYER_PARAMS = {
+    'max_depth': (1, 6),
+    'max_play_depth': (1, 4),
+    'fanout': (1, 16),
+    'beam_width': (1, 16),
+    'cheap_opponent_depth': (0, 4),
+    'opponent_cache_size': (0, 100000),
+    'position_memory': (0, 100),
+}
+
+MAX_N = 8
+MAX_SECONDS = 60.0
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_player_class(name, params):
+    """Returns the player class called name, if the (parsed) params have everything it needs"""
+    if not isinstance(name, str) or name not in PLAYER_CLASSES:
+        raise HttpError(400, "Unknown player class {!r}".format(name))
+    player_class, required = PLAYER_CLASSES[name]
+    missing = [key for key in required if key not in (params or {})]
+    if missing:
+        raise HttpError(400, "{} needs the player params {}".format(name, ", ".join(missing)))
+    return player_class
+
+
+def parse_params(params):
+    """Turns the JSON player params of a request into the params the players expect, refusing any
+    param that is not in PLAYER_PARAMS or out of its limits"""
+    if params is None:
+        return None
+    if not isinstance(params, dict):
+        raise HttpError(400, "The player params must be an object")
+    resolved = {}
+    for key, value in params.items():
+        if key in PLAYER_PARAMS:
+            low, high = PLAYER_PARAMS[key]
+            if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+                raise HttpError(400, "{} must be an integer from {} to {}".format(key, low, high))
+        elif key == 'branch_and_bound':
+            if not isinstance(value, bool):
+                raise HttpError(400, "branch_and_bound must be true or false")
+        elif key == 'evaluator':
+            if (not isinstance(value, dict) or not set(value) <= set(LinearEvaluator.FEATURES)
+                    or not all(is_number(weight) for weight in value.values())):
+                raise HttpError(400, "The evaluator must give a weight to some of {}".format(", ".join(LinearEvaluator.FEATURES)))
+            value = LinearEvaluator(**value)
+        elif key == 'cheap_opponent_class':
+            pass
+        elif key == 'cheap_opponent_params':
+            value = parse_params(value)
+        else:
+            raise HttpError(400, "The player param {!r} is not allowed".format(key))
+        resolved[key] = value
+    if 'cheap_opponent_class' in resolved:
+        resolved['cheap_opponent_class'] = parse_player_class(
+            resolved['cheap_opponent_class'], resolved.get('cheap_opponent_params', {})
+        )
+    return resolved
+
+
+def parse_spot(spot):
+    if not isinstance(spot, list) or len(spot) != 3 or not all(isinstance(x, int) for x in spot):
+        raise HttpError(400, "A spot must be a list of three integers, not {!r}".format(spot))
+    return tuple(spot)
+
+
+def parse_play(play):
+    if not isinstance(play, list) or len(play) < 2:
+        raise HttpError(400, "A play must be a list of at least two spots")
+    return [parse_spot(spot) for spot in play]
+
+
+class LatencyStats(object):
+    """Counts requests and keeps the latencies of the most recent ones, in seconds"""
+    def __init__(self, window=1000):
+        self.count = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.latencies.append(seconds)
+
+    def summary(self):
+        summary = { 'count': self.count, 'errors': self.errors }
+        if self.latencies:
+            latencies = np.array(self.latencies)
+            summary.update({
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            })
+        return summary
+
+
+class BotSession(object):
+    """A game and the bot that plays one of its colors"""
+    def __init__(self, session_id, player_class, player_params, colors, n, color, opponent_class=None, opponent_params=None):
+        if color not in colors:
+            raise HttpError(400, "The bot's color {!r} is not one of the colors".format(color))
+        self.id = session_id
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.game = Game(colors, n, board=board_for(n))
+        self.player = player_class(color, self.game, player_params)
+
+        # Planning players model the other colors, by default with the same kind of player
+        if hasattr(self.player, 'opponent_models'):
+            i = colors.index(color)
+            for other in colors[i + 1:] + colors[:i]:
+                self.player.opponent_models.append(
+                    (opponent_class or player_class)(other, self.game, opponent_params or player_params)
+                )
+
+    def set_position(self, player_spots, plies=0):
+        if not isinstance(player_spots, dict) or set(player_spots) != set(self.game.player_spots):
+            raise HttpError(400, "The position must have the spots of every color in the game")
+        if not all(isinstance(spots, list) for spots in player_spots.values()):
+            raise HttpError(400, "The spots of each color must be a list of spots")
+        if not isinstance(plies, int) or isinstance(plies, bool) or plies < 0:
+            raise HttpError(400, "plies must be a non-negative integer")
+        board_spots = set(self.game.board.board_spots)
+        spots = { color: [parse_spot(spot) for spot in spots] for color, spots in player_spots.items() }
+        for color, color_spots in spots.items():
+            if len(color_spots) != self.game.pieces_per_player or not board_spots.issuperset(color_spots):
+                raise HttpError(400, "{} must have {} pieces on the board".format(color, self.game.pieces_per_player))
+        self.game.player_spots = spots
+        self.game.move_stack = []
+        self.game.plies = plies
+
+    def apply(self, color, play):
+        if not isinstance(color, str) or color not in self.game.player_spots:
+            raise HttpError(400, "{!r} is not playing in this game".format(color))
+        if play[0] not in self.game.player_spots[color]:
+            raise HttpError(400, "{} has no piece in {}".format(color, list(play[0])))
+        if not self.game.is_legal_endpoint(color, play[0], play[-1]):
+            raise HttpError(400, "{} can not end a play in {}".format(color, list(play[-1])))
+
+        # Check every move of the play, and undo them all if any of them is illegal
+        n_pushes = 0
+        move_state = MoveState.FIRST
+        for start, end in zip(play, play[1:]):
+            legal, move_state = self.game.is_legal_move(color, start, end, move_state)
+            if not legal:
+                for _ in range(n_pushes):
+                    self.game.pop_move()
+                raise HttpError(400, "{} can not move from {} to {}".format(color, list(start), list(end)))
+            self.game.push_move(color, start, end, MoveState.ALREADY_CHECKED)
+            n_pushes += 1
+        del self.game.move_stack[len(self.game.move_stack) - n_pushes:]
+        self.game.plies += 1
+
+    def apply_all(self, plays):
+        """Applies the (color, play) pairs in order, or none of them if any of them is illegal"""
+        player_spots = { color: spots.copy() for color, spots in self.game.player_spots.items() }
+        plies = self.game.plies
+        try:
+            for color, play in plays:
+                self.apply(color, play)
+        except HttpError:
+            self.game.player_spots = player_spots
+            self.game.plies = plies
+            raise
+
+    def play(self, seconds=None, apply=True):
+        if not any(self.game.first_moves_by_piece(self.player.name)):
+            raise HttpError(409, "{} has no legal play".format(self.player.name))
+        self.game.deadline = Deadline(seconds) if seconds is not None else NO_DEADLINE
+        try:
+            play = self.player.play()
+        finally:
+            self.game.deadline = NO_DEADLINE
+        if apply:
+            self.apply(self.player.name, play)
+        return play
+
+
+class BotServer(object):
+    """Handles the requests for the bot sessions, independently of HTTP"""
+    def __init__(self, workers=None, max_queue=64, max_sessions=1000, session_ttl=3600.0):
+        self.workers = workers if workers else os.cpu_count()
+        self.max_queue = max_queue
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="bot")
+        self.slots = threading.BoundedSemaphore(self.workers + max_queue)
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
+        self.rejected = 0
+        self.in_flight = 0
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def record(self, endpoint, seconds, error=False):
+        with self.metrics_lock:
+            self.metrics.setdefault(endpoint, LatencyStats()).add(seconds, error)
+
+    def submit(self, func, *args):
+        """Runs func on the worker pool and waits for it, or raises a 503 if too many requests are waiting"""
+        if not self.slots.acquire(blocking=False):
+            with self.metrics_lock:
+                self.rejected += 1
+            raise HttpError(503, "Too many requests are waiting for a bot")
+        with self.metrics_lock:
+            self.in_flight += 1
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            with self.metrics_lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def session(self, session_id):
+        with self.sessions_lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            raise HttpError(404, "No session {!r}".format(session_id))
+        session.last_used = time.monotonic()
+        return session
+
+    def expire_sessions(self):
+        now = time.monotonic()
+        with self.sessions_lock:
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_used > self.session_ttl:
+                    del self.sessions[session_id]
+
+    def create_session(self, body):
+        player_params = parse_params(body.get('player_params', {}))
+        opponent_params = parse_params(body.get('opponent_params'))
+        player_class = parse_player_class(body.get('player_class'), player_params)
+        # The other colors are modelled by the bot's class and params unless they are given
+        opponent_class = parse_player_class(body.get('opponent_class', body.get('player_class')), opponent_params or player_params)
+        n = body.get('n', 4)
+        if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_N:
+            raise HttpError(400, "n must be an integer from 1 to {}".format(MAX_N))
+        colors = body.get('colors', ["red", "black"])
+        board_colors = list(board_for(n).colors)
+        if (not isinstance(colors, list) or len(colors) < 2 or len(set(map(str, colors))) != len(colors)
+                or not all(color in board_colors for color in colors)):
+            raise HttpError(400, "The colors must be two or more of {}".format(", ".join(board_colors)))
+        session = BotSession(
+            os.urandom(8).hex(),
+            player_class,
+            player_params,
+            colors,
+            n,
+            body.get('color', colors[-1]),
+            opponent_class,
+            opponent_params,
+        )
+        self.expire_sessions()
+        with self.sessions_lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise HttpError(503, "Too many sessions")
+            self.sessions[session.id] = session
+        return { 'session': session.id }
+
+    def metrics_summary(self):
+        with self.metrics_lock:
+            return {
+                'sessions': len(self.sessions),
+                'workers': self.workers,
+                'in_flight': self.in_flight,
+                'rejected': self.rejected,
+                'endpoints': { endpoint: stats.summary() for endpoint, stats in self.metrics.items() },
+            }
+
+    def route(self, method, path, body):
+        """Returns the response to a request, or raises an HttpError"""
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['metrics'] and method == 'GET':
+            return 'metrics', self.metrics_summary
+        if parts == ['sessions'] and method == 'POST':
+            return 'create', lambda: self.submit(self.create_session, body)
+        if len(parts) >= 2 and parts[0] == 'sessions':
+            session = self.session(parts[1])
+            action = (method, tuple(parts[2:]))
+            if action == ('DELETE', ()):
+                def delete():
+                    with self.sessions_lock:
+                        self.sessions.pop(session.id, None)
+                    return {}
+                return 'delete', delete
+            if action == ('PUT', ('position',)):
+                return 'position', lambda: self.locked(session, session.set_position, body.get('player_spots', {}), body.get('plies', 0))
+            if action == ('POST', ('moves',)):
+                return 'moves', lambda: self.locked(session, self.apply_moves, session, body.get('moves', []))
+            if action == ('POST', ('play',)):
+                return 'play', lambda: self.submit(self.locked, session, self.play, session, body)
+        raise HttpError(404, "No such endpoint: {} {}".format(method, path))
+
+    def locked(self, session, func, *args):
+        with session.lock:
+            result = func(*args)
+        return result if result is not None else {}
+
+    def apply_moves(self, session, moves):
+        if not isinstance(moves, list) or not all(isinstance(move, dict) for move in moves):
+            raise HttpError(400, "The moves must be a list of objects with a color and a play")
+        session.apply_all([(move.get('color'), parse_play(move.get('play'))) for move in moves])
+
+    def play(self, session, body):
+        seconds = body.get('seconds')
+        if seconds is not None and (not is_number(seconds) or not 0 < seconds <= MAX_SECONDS):
+            raise HttpError(400, "seconds must be a number from 0 to {}".format(MAX_SECONDS))
+        t0 = time.perf_counter()
+        play = session.play(seconds, body.get('apply', True))
+        return { 'play': [list(spot) for spot in play], 'seconds': time.perf_counter() - t0 }
+
+    def handle(self, method, path, body):
+        """Returns the status and the JSON response for a request"""
+        t0 = time.perf_counter()
+        endpoint = 'unknown'
+        try:
+            endpoint, respond = self.route(method, path, body if isinstance(body, dict) else {})
+            status, response = 200, respond()
+        except HttpError as e:
+            status, response = e.status, { 'error': str(e) }
+        except Exception:
+            # A bug must not take the handler thread down without an answer
+            traceback.print_exc()
+            status, response = 500, { 'error': "Internal server error" }
+        self.record(endpoint, time.perf_counter() - t0, status != 200)
+        return status, response
+
+
+class BotRequestHandler(BaseHTTPRequestHandler):
+    """Passes the requests on to the BotServer in self.server.bots"""
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_cors_headers(self):
+        # Only the configured client origin may call the server from a browser
+        allowed_origin = self.server.allowed_origin
+        if allowed_origin is None:
+            return
+        self.send_header("Access-Control-Allow-Origin", allowed_origin)
+        self.send_header("Vary", "Origin")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            self.send_json(400, { 'error': "The body is not valid JSON" })
+            return
+        self.send_json(*self.server.bots.handle(self.command, self.path, body))
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # The latencies are in /metrics, so do not log every request
+        pass
+
+
+def make_server(address=("localhost", 8765), allowed_origin=None, **kwargs):
+    """Returns an HTTP server for a new BotServer that answers browsers from allowed_origin; call serve_forever on it"""
+    httpd = ThreadingHTTPServer(address, BotRequestHandler)
+    httpd.daemon_threads = True
+    httpd.allowed_origin = allowed_origin
+    httpd.bots = BotServer(**kwargs)
+    return httpd
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the bots over HTTP")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, help="number of bot threads")
+    parser.add_argument("--max-queue", type=int, default=64, help="number of requests that can wait for a bot")
+    parser.add_argument("--allow-origin", help="origin of the web client, e.g. http://localhost:3000")
+    args = parser.parse_args(argv)
+
+    httpd = make_server((args.host, args.port), allowed_origin=args.allow_origin, workers=args.workers, max_queue=args.max_queue)
+    print("Serving bots on http://{}:{}".format(*httpd.server_address))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.bots.close()
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
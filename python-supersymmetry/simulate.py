@@ -0,0 +1,173 @@
+"""Runs a batch of simulations from a JSON config file, without plotting.
+
+Example config:
+
+    {
+        "player_class": "NonPlanningProgressMaximizer",
+        "player_params": { "max_depth": 5, "evaluator": { "progress": 1, "stragglers": 0.5 } },
+        "player_colors": ["red", "black"],
+        "n": 4,
+        "max_steps": 100,
+        "games": 1000,
+        "workers": 8,
+        "seed": 1,
+        "checkpoint": "results.checkpoint.npz",
+        "checkpoint_every": 100,
+        "profile": { "mode": "sample", "games": 10, "output": "profile.folded" },
+        "dataset": { "path": "data/", "chunk_size": 1048576 }
+    }
+
+Player classes are given by their name in players.py. Params whose name ends in "_class" are
+resolved the same way, an "evaluator" param is turned into a LinearEvaluator with the given weights,
+and an "opening_book" param is the path of a book built by opening_book.py.
+
+With a checkpoint, a run that is interrupted continues from the last checkpoint when it is started again.
+With a profile, every games-th game is profiled (see profiling.SimulationProfiler), the time spent in each
+phase of the engine is reported, and the stacks are written to the output in the collapsed flamegraph format.
+With a dataset, every play is exported as training data (see dataset.py); this needs a single worker.
+"""
+import argparse
+import json
+import sys
+
+from dataset import DatasetExportHooks
+import distributed
+from evaluation import LinearEvaluator
+from hooks import MultiHooks
+from opening_book import OpeningBook
+import players
+from profiling import SimulationProfiler
+from simulator import Simulator
+
+
+def resolve_params(params):
+    """Turns the JSON representation of player params into the params the players expect"""
+    if params is None:
+        return None
+    resolved = {}
+    for key, value in params.items():
+        if key.endswith('_class'):
+            value = getattr(players, value)
+        elif key == 'evaluator':
+            value = LinearEvaluator(**value)
+        elif key == 'opening_book':
+            value = OpeningBook(value)
+        resolved[key] = value
+    return resolved
+
+
+def profiler_from_config(config):
+    if 'profile' not in config:
+        return None
+    params = { key: value for key, value in config['profile'].items() if key != 'output' }
+    return SimulationProfiler(**params)
+
+
+def simulator_from_config(config):
+    return Simulator(
+        player_class=getattr(players, config['player_class']),
+        player_params=resolve_params(config.get('player_params', {})),
+        max_steps=config.get('max_steps', 50),
+        n=config.get('n', 4),
+        player_colors=tuple(config.get('player_colors', ("red", "black"))),
+        opponent_classes=[getattr(players, name) for name in config.get('opponent_classes', [])],
+        opponent_params=[resolve_params(params) for params in config.get('opponent_params', [])],
+        color_params={
+            color: resolve_params(params)
+            for color, params in config.get('color_params', {}).items()
+        },
+        seed=config.get('seed'),
+        profiler=profiler_from_config(config),
+    )
+
+
+class ProgressReporter(object):
+    """Writes the number of finished games and the throughput to stderr, at most once per interval"""
+    def __init__(self, total, interval=1.0, stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.last_report = -interval
+
+    def __call__(self, done, elapsed):
+        if elapsed - self.last_report < self.interval and done < self.total:
+            return
+        self.last_report = elapsed
+        rate = done / elapsed if elapsed else 0.0
+        self.stream.write("\r{}/{} games, {:.2f} games/s".format(done, self.total, rate))
+        if done == self.total:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run simulations without plotting")
+    parser.add_argument("config", help="JSON config file")
+    parser.add_argument("--output", help="where to write the results (.npz), overrides the config")
+    parser.add_argument("--games", type=int, help="number of games, overrides the config")
+    parser.add_argument("--workers", type=int, help="number of worker processes, overrides the config")
+    parser.add_argument("--seed", type=int, help="seed, overrides the config")
+    parser.add_argument("--checkpoint", help="where to checkpoint the run (.npz), overrides the config")
+    parser.add_argument("--profile", help="profile the run and write the stacks here, overrides the config")
+    parser.add_argument("--dataset", help="export every play as training data to this directory, overrides the config")
+    parser.add_argument("--listen", help="host:port to hand out the games to workers on (see distributed.py)")
+    parser.add_argument("--quiet", action="store_true", help="do not report progress")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    for key in ('output', 'games', 'workers', 'seed', 'checkpoint'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.profile is not None:
+        config['profile'] = { **config.get('profile', {}), 'output': args.profile }
+    if args.dataset is not None:
+        config['dataset'] = { **config.get('dataset', {}), 'path': args.dataset }
+
+    simulator = simulator_from_config(config)
+    dataset = None
+    if 'dataset' in config:
+        # The hooks do not run in worker processes
+        if args.listen or config.get('workers', 1) > 1:
+            parser.error("a dataset can only be exported with a single worker")
+        dataset = DatasetExportHooks(**config['dataset'])
+        simulator.hooks = MultiHooks(simulator.hooks, dataset)
+    games = config.get('games', 1)
+    # A run resumed from a checkpoint only plays the games that are left
+    games_left = games if args.listen else simulator.games_left(games, config.get('checkpoint'))
+    progress = None if args.quiet else ProgressReporter(games_left)
+    try:
+        if args.listen:
+            authkey = distributed.authkey_from_env()
+            if authkey is None:
+                parser.error("the SUPERSYMMETRY_AUTHKEY environment variable must be set to --listen")
+            coordinator = distributed.Coordinator(simulator, distributed.parse_address(args.listen), authkey)
+            try:
+                coordinator.run(games, progress=progress)
+            finally:
+                coordinator.close()
+        else:
+            simulator.execute(
+                games,
+                workers=config.get('workers', 1),
+                progress=progress,
+                checkpoint=config.get('checkpoint'),
+                checkpoint_every=config.get('checkpoint_every', 100),
+            )
+    finally:
+        # Write the plays that were recorded, even if the run was interrupted
+        if dataset is not None:
+            dataset.close()
+
+    output = config.get('output', 'results.npz')
+    simulator.results.save(output)
+
+    if simulator.profiler is not None:
+        simulator.profiler.write_collapsed(config['profile'].get('output', 'profile.folded'))
+        if not args.quiet:
+            sys.stderr.write(simulator.profiler.report() + "\n")
+    return simulator
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
-from itertools import combinations
+import asyncio
+import copy
+import multiprocessing
+import os
+import random
+import time
 
-from matplotlib import pyplot as plt
+import numpy as np
 
 from game import Game
-from hooks import NoHooks
+from hooks import NoHooks, compile_hooks
+from results import ResultStore
 
 def populate_opponent_models(game, players, model_classes, model_params):
     m = len(players)
@@ -32,14 +38,22 @@ class Simulator(object):
         player_colors = ("red","black",),
         opponent_classes=None,
         opponent_params=None,
+        color_params=None,
+        seed=None,
+        time_control=None,
+        profiler=None,
     ):
         self.n = n
         self.hooks = hooks if hooks else NoHooks()
         self.player_colors = player_colors
         self.player_class = player_class
         self.player_params = player_params
+        self.color_params = color_params if color_params else {}
+        self.seed = seed
+        self.time_control = time_control
+        self.profiler = profiler
         self.max_steps = max_steps
-        self.winners = []
+        self.results = ResultStore(player_colors)
         
         if opponent_classes:
             self.opponent_classes = opponent_classes
@@ -50,79 +64,179 @@ class Simulator(object):
             self.opponent_params = opponent_params
         else:
             self.opponent_params =  [{} for opponent_class in self.opponent_classes]
+
+    @property
+    def winners(self):
+        return self.results.winners()
     
-    def execute(self, n_sims):
-        for run in range(n_sims):
-            game = Game(self.player_colors, self.n)
-            
-            player_list = [
-                self.player_class(color, game, self.player_params)
-                for color in self.player_colors
-            ]
-            player_dict={
-                player.name: player
-                for player in player_list
-            }
-            if self.opponent_classes:
-                populate_opponent_models(game, player_list, self.opponent_classes, self.opponent_params)
-            winners_this_run = game.run(
-                max_steps=self.max_steps,
-                players=player_dict,
-                hooks=self.hooks
-            )
-            self.winners.append(winners_this_run)
-
-class ResultPlotter(object):
-    def __init__(self, simulator):
-        self.simulator = simulator
-    
-    def get_dists(self):
-        return {
-            color: [
-                steps
-                for step_winners
-                in self.simulator.winners
-                for color_, steps
-                in step_winners
-                if color_ == color
-            ]
-            for color in self.simulator.player_colors
+    def game_seed(self, game_id):
+        """Returns the seed for the given game, so that every game can be replayed on its own"""
+        return int(np.random.SeedSequence([self.seed, game_id]).generate_state(1)[0])
+
+    def new_game(self, game_id):
+        """Sets up a game and its players, and returns the game and a mapping from color to player"""
+        if self.seed is not None:
+            seed = self.game_seed(game_id)
+            random.seed(seed)
+            np.random.seed(seed)
+
+        game = Game(self.player_colors, self.n)
+        game.game_id = game_id
+        
+        player_list = [
+            self.player_class(color, game, self.color_params.get(color, self.player_params))
+            for color in self.player_colors
+        ]
+        player_dict={
+            player.name: player
+            for player in player_list
         }
+        if self.opponent_classes:
+            populate_opponent_models(game, player_list, self.opponent_classes, self.opponent_params)
+        return game, player_dict
+
+    def play_game(self, game_id, hooks=None):
+        """Plays a single game and returns its win sequence"""
+        game, player_dict = self.new_game(game_id)
+        hooks = hooks if hooks is not None else self.hooks
+        if self.profiler is not None:
+            return self.profiler.run(game_id, game.run, self.max_steps, player_dict, hooks, self.time_control)
+        return game.run(
+            max_steps=self.max_steps,
+            players=player_dict,
+            hooks=hooks,
+            time_control=self.time_control
+        )
     
-    def plot_distributions(self):
-        plt.figure(figsize=(7, 7))
-        dists = self.get_dists()
-        for color, dist in dists.items():
-            plt.hist(
-                dist, 
-                alpha=0.8,
-                color=color,
-                bins=15
-            )
-        plt.xlabel("Number of moves")
-        plt.ylabel("Density")
-        plt.title("Distribution of game lengths")
-        plt.show()
-    
-    def plot_correlations(self):
-        dists = self.get_dists()
-        for color_x, color_y in combinations(self.simulator.player_colors, 2):
-            plt.figure(figsize=(7, 7))
-            dist_x = dists[color_x]
-            dist_y = dists[color_y]
-            min_ = min(*dist_x, *dist_y)
-            max_ = max(*dist_x, *dist_y)
-            ties = [(x, y) for x, y in zip(dist_x, dist_y) if x == y]
-            dist_x, dist_y = [x for x, y in zip(dist_x, dist_y) if x != y], [y for x, y in zip(dist_x, dist_y) if x != y]
-            colors = [color_x if x < y else color_y for x, y in zip(dist_x, dist_y)]
-
-            plt.scatter(dist_x, dist_y, alpha=0.5, color=colors)
-            if ties:
-                plt.scatter(*zip(*ties), marker="x")
-            plt.xlabel("#moves by {}".format(color_x))
-            plt.ylabel("#moves by {}".format(color_y))
-            plt.xlim(min_ - 1, max_ + 1)
-            plt.ylim(min_ - 1, max_ + 1)
-            plt.title("Matchup: {} vs. {}".format(color_x, color_y))
-            plt.axis("equal")
-            plt.show()
+    def execute(self, n_sims, workers=1, progress=None, checkpoint=None, checkpoint_every=100):
+        """Plays n_sims games and adds the results to self.results.
+
+        With more than one worker, the games are played in a process pool, where the hooks can not run,
+        so a ValueError is raised if the simulator has hooks.
+        The results do not depend on the number of workers if the simulator has a seed; if it does not,
+        a seed is drawn for the run so that the workers play different games.
+        If given, progress is called with the number of games finished so far and the elapsed time after every game.
+
+        If a checkpoint path is given, the results and the seed are saved there every checkpoint_every games.
+        If the checkpoint already exists, the run continues from it instead of starting over,
+        and plays the games that are left to reach the total it was started with.
+        """
+        t0 = time.perf_counter()
+        if workers > 1 and compile_hooks(self.hooks):
+            raise ValueError("The hooks can not run in worker processes, play with one worker to run them")
+        seed = self.seed
+        if checkpoint and os.path.exists(checkpoint):
+            target, seed = self.load_checkpoint(checkpoint)
+        else:
+            target = self.results.n_games + n_sims
+        if (workers > 1 or checkpoint) and seed is None:
+            seed = random.randrange(2**32)
+
+        # The run has its own seed, and shares everything else with the simulator
+        run = copy.copy(self)
+        run.seed = seed
+
+        game_ids = range(self.results.n_games, target)
+        for i, (game_id, winners_this_run) in enumerate(run.play_games(game_ids, workers)):
+            self.results.add_game(winners_this_run, game_id)
+            if progress:
+                progress(i + 1, time.perf_counter() - t0)
+            if checkpoint and (i + 1) % checkpoint_every == 0:
+                run.save_checkpoint(checkpoint, target)
+        if checkpoint:
+            run.save_checkpoint(checkpoint, target)
+
+    async def execute_async(self, n_sims, concurrency=100, executor=None, progress=None):
+        """Plays n_sims games on the running event loop, at most concurrency of them at a time,
+        and adds the results to self.results in the order of the game ids.
+
+        Players whose play method is a coroutine function are awaited, and the other players play
+        in the executor (see Game.run_async). The hooks are shared by the games that run at the same time,
+        and so are the random number generators, so the games are not reproducible from the seed.
+        If given, progress is called with the number of games finished so far and the elapsed time after every game.
+        """
+        t0 = time.perf_counter()
+        semaphore = asyncio.Semaphore(concurrency)
+        finished = 0
+
+        async def play_game(game_id):
+            nonlocal finished
+            async with semaphore:
+                game, player_dict = self.new_game(game_id)
+
+                # Each game has its own clocks and deadline, but the statistics are shared
+                time_control = copy.copy(self.time_control)
+                win_sequence = await game.run_async(self.max_steps, player_dict, self.hooks, time_control, executor)
+            finished += 1
+            if progress:
+                progress(finished, time.perf_counter() - t0)
+            return win_sequence
+
+        first_game = self.results.n_games
+        win_sequences = await asyncio.gather(*(
+            play_game(game_id) for game_id in range(first_game, first_game + n_sims)
+        ))
+        for game_id, win_sequence in enumerate(win_sequences, first_game):
+            self.results.add_game(win_sequence, game_id)
+
+    def play_games(self, game_ids, workers=1):
+        """Plays the games with the given ids, and yields (game id, win sequence) in order"""
+        if workers > 1:
+            with multiprocessing.Pool(workers, initializer=init_worker, initargs=(self.worker_copy(),)) as pool:
+                for game_id, win_sequence, profile in pool.imap(play_in_worker, game_ids):
+                    if profile is not None:
+                        self.profiler.merge(profile)
+                    yield game_id, win_sequence
+            return
+
+        hooks = compile_hooks(self.hooks)
+        for game_id in game_ids:
+            yield game_id, self.play_game(game_id, hooks)
+
+    def save_checkpoint(self, path, target):
+        """Atomically saves the results, the seed and the number of games the run should reach"""
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            self.results.save(f, seed=self.seed, target=target)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def games_left(self, n_sims, checkpoint=None):
+        """Returns the number of games execute will play, which is fewer than n_sims when it resumes from the checkpoint"""
+        if checkpoint and os.path.exists(checkpoint):
+            with np.load(checkpoint) as data:
+                return int(data['target']) - int(data['n_games'])
+        return n_sims
+
+    def load_checkpoint(self, path):
+        """Restores the results, and returns the number of games the run should reach and the seed of the run"""
+        self.results.read(path)
+        with np.load(path) as data:
+            return int(data['target']), int(data['seed'])
+
+    def worker_copy(self):
+        """Returns a copy without the results, the hooks and the recorded profile, that is cheap to send to worker processes"""
+        simulator = copy.copy(self)
+        simulator.results = None
+        simulator.hooks = NoHooks()
+        if self.profiler is not None:
+            # Each worker records its own stacks, which are merged back after every game
+            simulator.profiler = copy.copy(self.profiler)
+            simulator.profiler.take()
+        return simulator
+
+
+# The simulator used by each worker process in Simulator.execute
+worker_simulator = None
+
+
+def init_worker(simulator):
+    global worker_simulator
+    worker_simulator = simulator
+
+
+def play_in_worker(game_id):
+    win_sequence = worker_simulator.play_game(game_id, {})
+    profiler = worker_simulator.profiler
+    return game_id, win_sequence, profiler.take() if profiler is not None else None
@@ -0,0 +1,98 @@
+from functools import lru_cache
+import hashlib
+
+from board import Board
+from game import Game
+
+
+@lru_cache(maxsize=None)
+def board_for(n):
+    """Returns a shared Board of the given size, so that its geometry is only built once"""
+    return Board(n)
+
+
+class GameState(object):
+    """An immutable, compact snapshot of a game position.
+
+    Occupancy is stored as one byte per spot in board.board_spots: 0 for an empty spot,
+    or 1 + the index of the color in colors. to_move is the index of the color to move.
+    Copying a state is a copy of the bytes, and a pickled state is a couple of hundred bytes.
+    """
+    __slots__ = ('n', 'colors', 'cells', 'to_move', '_hash')
+
+    def __init__(self, n, colors, cells, to_move=0):
+        self.n = n
+        self.colors = tuple(colors)
+        self.cells = bytes(cells)
+        self.to_move = to_move
+        self._hash = hash((self.n, self.colors, self.cells, self.to_move))
+
+    @classmethod
+    def from_game(cls, game, to_move=None):
+        """Takes a snapshot of the game. to_move is either a color or its index (by default the first color)"""
+        colors = list(game.player_spots)
+        spot_index = game.board.spot_index
+        cells = bytearray(len(game.board.board_spots))
+        for i, spots in enumerate(game.player_spots.values()):
+            for spot in spots:
+                cells[spot_index[spot]] = i + 1
+        if to_move in game.player_spots:
+            to_move = colors.index(to_move)
+        return cls(game.board.n, colors, cells, to_move or 0)
+
+    def to_game(self):
+        """Creates a Game in this position"""
+        game = Game(self.colors, self.n, board=board_for(self.n))
+        game.player_spots = self.player_spots(game.board)
+        return game
+
+    def player_spots(self, board=None):
+        """Returns a mapping from color to the spots of its pieces, in board_spots order"""
+        board = board if board is not None else board_for(self.n)
+        player_spots = { color: [] for color in self.colors }
+        for spot, cell in zip(board.board_spots, self.cells):
+            if cell:
+                player_spots[self.colors[cell - 1]].append(spot)
+        return player_spots
+
+    @property
+    def color(self):
+        """The color to move"""
+        return self.colors[self.to_move]
+
+    def copy(self):
+        return GameState(self.n, self.colors, self.cells, self.to_move)
+
+    def with_move(self, start, end):
+        """Returns the state after moving the piece at spot index start to spot index end"""
+        cells = bytearray(self.cells)
+        cells[end] = cells[start]
+        cells[start] = 0
+        return GameState(self.n, self.colors, cells, self.to_move)
+
+    def with_next_to_move(self):
+        return GameState(self.n, self.colors, self.cells, (self.to_move + 1) % len(self.colors))
+
+    def digest(self):
+        """Returns a 64-bit hash of the state that is the same in every process"""
+        data = bytes([self.n, self.to_move]) + ",".join(self.colors).encode() + self.cells
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, GameState):
+            return NotImplemented
+        return (self.n, self.colors, self.cells, self.to_move) == (other.n, other.colors, other.cells, other.to_move)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_hash'):
+            raise AttributeError("GameState is immutable")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return (GameState, (self.n, self.colors, self.cells, self.to_move))
+
+    def __repr__(self):
+        return "GameState(n={}, colors={}, to_move={})".format(self.n, self.colors, self.color)
@@ -1,13 +1,36 @@
+import asyncio
+import heapq
+import json
+import pickle
+import random
+import subprocess
+import sys
+import threading
+
 import numpy as np
 import pytest
 
 from coordinate_transformer import CoordinateTransformer
-from game import Game
+from dataset import Dataset, DatasetExportHooks
+from distributed import Coordinator, start_workers
+from evaluation import LinearEvaluator
+from game import Game, MoveState
 from board import Board
 from hex_grid_algorithms import grid_spiral, grid_brute_force, grid_fast, grid_redblob
-from hooks import NoHooks, MultiHooks
-from players import RandomPlayer, NonPlanningProgressMaximizer, PlanningProgressMaximizer, RandomSingleMovePlayer, SingleMoveProgressMaximizer
+from hooks import NoHooks, MultiHooks, ProgressTrackerHooks, EventRecorderHooks, GameHooks
+import perft
+from opening_book import OpeningBook, build_book
+from parallel_search import SearchPool
+from players import BeamSearchPlayer, RandomPlayer, NonPlanningProgressMaximizer, PlanningProgressMaximizer, RandomSingleMovePlayer, SingleMoveProgressMaximizer, ResponseCache
+from profiling import PHASES, SimulationProfiler, phase_of
+from plotters import PlotHooks, BackgroundPlotHooks, ResultPlotter
 from simulator import Simulator
+import simulate
+from server import BotServer, HttpError, make_server
+from state import GameState
+from timecontrol import Deadline, TimeControl
+from tuning import ParameterSpace, SuccessiveHalving, strength_for_cpu
+from results import GrowableArray, ResultStore, match_score
 import plotlib
 import plots
 
@@ -67,6 +90,15 @@ def test_can_create_board():
     board = Board()
     board = Board(n=8)
 
+    # Only the spots of the star are kept: the central hexagon and the six triangles
+    for n in range(1, 6):
+        board = Board(n)
+        grid = grid_fast(2 * n)
+        assert board.field_spots == [vec for vec in grid if board.in_field(vec)]
+        assert board.color_spots == { color: [vec for vec in grid if func(vec)] for color, func in board.colors.items() }
+        assert len(board.board_spots) == 6 * n * n + 6 * n + 1
+        assert board.neighbours.tolist() == board.neighbour_table
+
 
 def test_hex_algorithms():
     assert grid_fast(4) == [(-4, 0, -4), (-4, 1, -3), (-4, 2, -2), (-4, 3, -1), (-4, 4, 0), (-3, -1, -4), (-3, 0, -3), (-3, 1, -2), (-3, 2, -1), (-3, 3, 0), (-3, 4, 1), (-2, -2, -4), (-2, -1, -3), (-2, 0, -2), (-2, 1, -1), (-2, 2, 0), (-2, 3, 1), (-2, 4, 2), (-1, -3, -4), (-1, -2, -3), (-1, -1, -2), (-1, 0, -1), (-1, 1, 0), (-1, 2, 1), (-1, 3, 2), (-1, 4, 3), (0, -4, -4), (0, -3, -3), (0, -2, -2), (0, -1, -1), (0, 0, 0), (0, 1, 1), (0, 2, 2), (0, 3, 3), (0, 4, 4), (1, -4, -3), (1, -3, -2), (1, -2, -1), (1, -1, 0), (1, 0, 1), (1, 1, 2), (1, 2, 3), (1, 3, 4), (2, -4, -2), (2, -3, -1), (2, -2, 0), (2, -1, 1), (2, 0, 2), (2, 1, 3), (2, 2, 4), (3, -4, -1), (3, -3, 0), (3, -2, 1), (3, -1, 2), (3, 0, 3), (3, 1, 4), (4, -4, 0), (4, -3, 1), (4, -2, 2), (4, -1, 3), (4, 0, 4)]
@@ -84,3 +116,905 @@ def test_hex_algorithms():
 
 def test_can_create_simulator():
     simulator = Simulator(RandomPlayer)
+
+
+def test_growable_array():
+    array = GrowableArray([('a', np.int32)], capacity=1)
+    for i in range(10):
+        array.append((i,))
+    array.extend([(10,), (11,)])
+    assert len(array) == 12
+    assert list(array.data['a']) == list(range(12))
+
+
+def test_result_store():
+    store = ResultStore(("red", "black"))
+    store.add_game([("red", 10), ("black", 12)])
+    store.add_game([("black", 8), ("red", 9)])
+    store.add_game([("red", 7), ("black", 7)])
+    assert eq(store.dists()["red"], [10, 9, 7])
+    assert eq(store.dists()["black"], [12, 8, 7])
+    assert eq(store.win_matrix(), [[0, 1], [1, 0]])
+    assert store.winners()[1] == [("black", 8), ("red", 9)]
+
+    store.add_progress(0, "red", 0, 1.0)
+    store.add_progress(0, "red", 1, 3.0)
+    store.add_progress(2, "red", 0, 2.0)
+    curves = store.progress_curves("red")
+    assert curves.shape == (3, 2)
+    assert eq(curves[0], [1.0, 3.0])
+    assert np.isnan(curves[1]).all()
+
+
+def test_simulator_results():
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=10, n=2)
+    simulator.hooks = ProgressTrackerHooks(simulator.results)
+    simulator.execute(3)
+    assert len(simulator.winners) == 3
+    dists = ResultPlotter(simulator).get_dists()
+    assert all(len(dist) == 3 for dist in dists.values())
+    assert simulator.results.progress_curves("red").shape[0] == 3
+
+
+def test_background_plot_hooks(tmp_path):
+    hooks = BackgroundPlotHooks(
+        fig_format=str(tmp_path / "frame-{}-{}.png"),
+        max_queue=2,
+        animation_path=str(tmp_path / "game-{}.gif"),
+    )
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=2, n=2, hooks=hooks)
+    simulator.execute(2)
+
+    # One renderer draws every game, until the hooks are closed
+    worker = hooks.worker
+    assert worker.is_alive()
+    hooks.close()
+    assert worker.exitcode == 0 and hooks.worker is None
+    expected = ["frame-{}-{}.png".format(game, i) for game in range(2) for i in range(1, 5)]
+    assert sorted(path.name for path in tmp_path.glob("frame-*.png")) == expected
+    assert (tmp_path / "game-0.gif").exists() and (tmp_path / "game-1.gif").exists()
+
+    # A dead renderer stops the game instead of blocking it forever
+    hooks = BackgroundPlotHooks(fig_format=str(tmp_path / "dead-{}-{}.png"), max_queue=1, put_timeout=0.1)
+    game = Game(["red", "black"], n=2)
+    hooks.before_game(game)
+    hooks.worker.terminate()
+    hooks.worker.join()
+    hooks.before_play("red", None)
+    with pytest.raises(RuntimeError):
+        hooks.after_play("red", None, [game.player_spots["red"][0]])
+
+
+def test_plot_hooks(tmp_path):
+    hooks = PlotHooks(fig_format=str(tmp_path / "frame-{}.png"), save_fig=True)
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=2, n=2, hooks=hooks)
+    simulator.execute(1)
+    assert len(list(tmp_path.glob("frame-*.png"))) == 4
+    assert len(hooks.plotter.move_artists) == 1
+
+    hooks = PlotHooks()
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=2, n=2, hooks=hooks)
+    simulator.execute(1)
+    assert hooks.plotter.background is not None
+
+
+def test_compiled_hooks():
+    class RoundCounter(GameHooks):
+        def __init__(self):
+            self.before = 0
+            self.after = 0
+
+        def before_round(self):
+            self.before += 1
+
+        def after_round(self):
+            self.after += 1
+
+    counter = RoundCounter()
+    progress = ProgressTrackerHooks()
+    assert set(counter.compile()) == {'before_round', 'after_round'}
+    assert NoHooks().compile() == {}
+
+    hooks = MultiHooks(NoHooks(), counter, progress)
+    dispatch = hooks.compile()
+    assert set(dispatch) == {'before_round', 'after_round', 'before_game', 'after_play'}
+    assert dispatch['before_round'] == counter.before_round
+
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=5, n=2, hooks=hooks)
+    simulator.execute(1)
+    assert counter.before == 5
+    assert counter.after == 5
+
+
+def test_event_recorder_hooks():
+    recorder = EventRecorderHooks()
+    simulator = Simulator(SingleMoveProgressMaximizer, {}, max_steps=3, n=2, hooks=recorder)
+    simulator.execute(2)
+    assert len(recorder.games) == 2
+    colors, plays, moves = recorder.games[0]
+    assert colors == ["red", "black"]
+    assert len(plays) == 6
+    assert list(plays['color']) == [0, 1] * 3
+    assert len(moves) == plays['n_moves'].sum()
+
+
+def test_progress_vectors():
+    board = Board(3)
+    for color, function in board.progress_function.items():
+        assert eq(board.spot_array @ board.progress_vectors[color], [function(spot) for spot in board.board_spots])
+
+
+def test_batched_evaluation():
+    game = Game(["red", "black"], n=3)
+    player = NonPlanningProgressMaximizer("red", game, {'max_depth': 3})
+    scores, plays = player.evaluate()
+    progress = game.board.progress_function["red"]
+    assert eq(scores, [progress(play[-1]) - progress(play[0]) for play in plays])
+
+    heap = player.build_heap()
+    assert player.top_k(4) == [heapq.heappop(heap)[1] for _ in range(4)]
+
+    # Plays that tie with the k-th score are ranked like in the heap
+    for n in (2, 3, 4):
+        tie_game = Game(["red", "black"], n=n)
+        single = SingleMoveProgressMaximizer("red", tie_game, {})
+        tie_scores, _ = single.evaluate()
+        assert len(np.unique(tie_scores)) < len(tie_scores)
+        for k in range(1, len(tie_scores) + 2):
+            heap = single.build_heap()
+            assert single.top_k(k) == [heapq.heappop(heap)[1] for _ in range(min(k, len(tie_scores)))]
+    assert single.top_k(0) == []
+
+    random.seed(1)
+    best = player.choose_best(scores, plays)
+    random.seed(1)
+    assert best == player.choose(player.build_heap())
+
+    evaluator = LinearEvaluator(progress=1, pieces_home=1, stragglers=1, mobility=1)
+    spot_index = game.board.spot_index
+    starts = np.array([spot_index[play[0]] for play in plays])
+    ends = np.array([spot_index[play[-1]] for play in plays])
+    features = evaluator.features(game, "red", scores, starts, ends)
+    assert features.shape == (len(plays), 4)
+    assert eq(evaluator(game, "red", scores, starts, ends), features.sum(axis=1))
+    assert (features[:, 1] == 0).all()
+
+
+def test_seeded_games_are_reproducible():
+    simulator = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=3)
+    assert simulator.play_game(5) == simulator.play_game(5)
+
+
+def test_successive_halving(tmp_path):
+    assert match_score([("red", 5), ("black", 7)], "red") == 1.0
+    assert match_score([("red", 5), ("black", 5)], "black") == 0.5
+
+    # A candidate that answers at once can not make up for losing every game
+    assert strength_for_cpu(0.6, 0.1) > strength_for_cpu(0.0, 1e-9)
+    assert strength_for_cpu(0.5, 0.01) > strength_for_cpu(0.5, 0.02)
+
+    checkpoint = str(tmp_path / "search.pickle")
+    search = SuccessiveHalving(
+        NonPlanningProgressMaximizer,
+        ParameterSpace(max_depth=(1, 3)),
+        baseline_params={'max_depth': 2},
+        n_candidates=4,
+        cpu_budget=0.01,
+        workers=2,
+        n=2,
+        max_steps=10,
+        checkpoint=checkpoint,
+    )
+    best = search.run()
+    assert 1 <= best['max_depth'] <= 3
+    assert len(search.state['remaining']) == 1
+    assert len(search.results()) == 4
+
+    resumed = SuccessiveHalving(
+        NonPlanningProgressMaximizer,
+        ParameterSpace(max_depth=(1, 3)),
+        baseline_params={'max_depth': 2},
+        checkpoint=checkpoint,
+    )
+    assert resumed.best() == best
+
+
+def test_response_cache():
+    cache = ResponseCache(2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    assert cache.get("b") is None
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_planning_opponent_models():
+    game = Game(["red", "black"], n=2)
+    params = {
+        'max_depth': 2,
+        'fanout': 2,
+        'max_play_depth': 2,
+        'cheap_opponent_class': SingleMoveProgressMaximizer,
+    }
+    player = PlanningProgressMaximizer("red", game, params)
+    player.opponent_models.append(NonPlanningProgressMaximizer("black", game, {'max_depth': 2}))
+    position = game.position()
+    player.play()
+    assert game.position() == position
+    assert len(player.opponent_cache) > 0
+    assert isinstance(player.opponents_at(1)[0], SingleMoveProgressMaximizer)
+    assert isinstance(player.opponents_at(0)[0], NonPlanningProgressMaximizer)
+
+
+def test_deadline():
+    assert not Deadline().expired()
+    assert Deadline(0).expired()
+    assert Deadline(0).remaining() == 0
+
+
+def test_time_control():
+    time_control = TimeControl(per_play=0.0, per_game=10.0, grace=1.0)
+    params = {'max_depth': 4, 'fanout': 3, 'max_play_depth': 3}
+    simulator = Simulator(PlanningProgressMaximizer, params, max_steps=3, n=3, time_control=time_control)
+    simulator.execute(1)
+    stats = time_control.stats()
+    assert stats["red"]["plays"] == 3
+    assert stats["red"]["overruns"] == 0
+    assert stats["red"]["max_seconds"] < 1.0
+    assert time_control.clocks["red"] < 10.0
+
+
+def test_game_state():
+    game = Game(["red", "black", "green"])
+    state = GameState.from_game(game, "black")
+    assert state.color == "black"
+    assert len(pickle.dumps(state)) < 300
+    assert pickle.loads(pickle.dumps(state)) == state
+    assert hash(state.copy()) == hash(state)
+    assert len({state, state.copy(), state.with_next_to_move()}) == 2
+    with pytest.raises(AttributeError):
+        state.to_move = 0
+
+    restored = state.to_game()
+    assert {color: set(spots) for color, spots in restored.player_spots.items()} == {color: set(spots) for color, spots in game.player_spots.items()}
+    assert GameState.from_game(restored, "black") == state
+
+    start = game.board.spot_index[game.player_spots["red"][0]]
+    end = game.board.spot_index[(0, 0, 0)]
+    moved = state.with_move(start, end)
+    assert moved != state
+    assert moved.digest() != state.digest()
+    assert moved.to_game().player_spots["red"].count((0, 0, 0)) == 1
+
+
+def test_perft():
+    for n, colors, depth, expected, result in perft.check_reference(max_n=2):
+        assert result.nodes == expected
+        assert result.nodes_per_second > 0
+
+    game = Game(["red", "black"], n=3)
+    plays = perft.legal_plays(game, "red")
+    assert len(plays) == perft.REFERENCE_COUNTS[(3, ("red", "black"), 1)]
+    assert all(game.is_legal_endpoint("red", start, end) for start, end in plays)
+
+
+def test_large_board():
+    for n, colors, depth, expected, result in perft.check_reference(max_n=3, large_board=True):
+        assert result.nodes == expected
+
+    assert Game(["red", "black"], n=10).large_board
+    assert not Game(["red", "black"], n=4).large_board
+
+    # Walking along the rays finds the same moves as looking at every spot, in the same order
+    board = Board(5)
+    rng = random.Random(0)
+    spots = rng.sample(board.board_spots, 45)
+    player_spots = { "red": spots[:15], "black": spots[15:30], "green": spots[30:] }
+    games = [Game(["red", "black", "green"], board=board, large_board=large_board) for large_board in (False, True)]
+    for game in games:
+        game.player_spots = { color: list(color_spots) for color, color_spots in player_spots.items() }
+    for spot in player_spots["red"]:
+        for move_state in (MoveState.FIRST, MoveState.SUBSEQUENT, MoveState.SUBSEQUENT_AFTER_SINGLE_MOVE):
+            moves = games[0].get_legal_moves("red", spot, move_state)
+            assert games[1].get_legal_moves("red", spot, move_state) == moves
+            for end in board.board_spots[::7]:
+                assert games[1].is_legal_move("red", spot, end, move_state) == games[0].is_legal_move("red", spot, end, move_state)
+
+    # The occupancy follows the moves
+    game = games[1]
+    start, (end, _) = player_spots["red"][0], games[1].get_legal_moves("red", player_spots["red"][0])[0]
+    game.push_move("red", start, end, MoveState.FIRST)
+    assert game.occupancy[board.spot_index[end]] and not game.occupancy[board.spot_index[start]]
+    game.pop_move()
+    assert game.occupancy[board.spot_index[start]] and not game.occupancy[board.spot_index[end]]
+
+    rows = perft.scaling(ns=(4, 10), max_area_n=4)
+    assert [row[2] for row in rows] == [20, 110]
+    assert rows[1][4] is None
+
+
+def test_branch_and_bound():
+    game = Game(["red", "black"], n=4, large_board=True)
+    players = {
+        color: [
+            NonPlanningProgressMaximizer(color, game, { 'max_depth': 4, 'branch_and_bound': branch_and_bound })
+            for branch_and_bound in (True, False)
+        ]
+        for color in ("red", "black")
+    }
+    assert players["red"][0].progress_weight() == 1.0
+    assert players["red"][1].progress_weight() is None
+    assert NonPlanningProgressMaximizer("red", game, { 'max_depth': 4, 'evaluator': LinearEvaluator(mobility=1.0) }).progress_weight() is None
+
+    # Pruning does not change the plays, including how ties are broken
+    for ply in range(30):
+        color = ("red", "black")[ply % 2]
+        plays = []
+        for player in players[color]:
+            random.seed(ply)
+            plays.append(player.play())
+        assert plays[0] == plays[1]
+        for start, end in zip(plays[0], plays[0][1:]):
+            game.do_move(color, start, end)
+
+    # The bound covers every spot the depth-first search reaches
+    player = players["red"][1]
+    for start in game.player_spots["red"]:
+        reachable = game.reachable("red", start, 4)
+        assert set(player.move_tree(start).nodes()) - {start} <= reachable
+        assert game.player_spots["red"].count(start) == 1 and game.occupancy[game.board.spot_index[start]]
+
+
+def test_beam_search_player():
+    game = Game(["red", "black"], n=3)
+    params = {'max_depth': 2, 'max_play_depth': 1, 'fanout': 100, 'beam_width': 2}
+    player = BeamSearchPlayer("red", game, {**params, 'beam_width': 100})
+    player.opponent_models.append(SingleMoveProgressMaximizer("black", game, {}))
+
+    # One play deep, the lines are the plays of the move finder (one per position they lead to)
+    finder = NonPlanningProgressMaximizer("red", game, {'max_depth': 2})
+    finder_scores, finder_plays = finder.evaluate()
+    scores, plays = player.evaluate()
+    assert {(play[0], play[-1]) for play in plays} == {(play[0], play[-1]) for play in finder_plays}
+    assert scores.max() == finder_scores.max()
+
+    # The line scores are the evaluator's scores, and are not passed through the evaluator again
+    evaluator = LinearEvaluator(progress=1.0, mobility=0.5)
+    player = BeamSearchPlayer("red", game, {**params, 'beam_width': 100, 'evaluator': evaluator})
+    player.opponent_models.append(SingleMoveProgressMaximizer("black", game, {}))
+    finder = NonPlanningProgressMaximizer("red", game, {'max_depth': 2, 'evaluator': evaluator})
+    finder_scores, finder_plays = finder.evaluate()
+    finder_best = {}
+    for score, play in zip(finder_scores, finder_plays):
+        finder_best[play[0], play[-1]] = max(score, finder_best.get((play[0], play[-1]), score))
+    scores, plays = player.evaluate()
+    for score, play in zip(scores, plays):
+        assert score == pytest.approx(finder_best[play[0], play[-1]])
+
+    # Deeper, the beam keeps at most beam_width lines, and the cost grows linearly with the depth
+    for max_play_depth in (2, 4):
+        player = BeamSearchPlayer("red", game, {**params, 'max_play_depth': max_play_depth, 'fanout': 3})
+        player.opponent_models.append(SingleMoveProgressMaximizer("black", game, {}))
+        calls = []
+        scored_top_k = player.move_finder.scored_top_k
+        player.move_finder.scored_top_k = lambda k: calls.append(k) or scored_top_k(k)
+        scores, plays = player.evaluate()
+        assert 1 <= len(plays) <= 2
+        assert len(calls) <= 1 + 2 * (max_play_depth - 1)
+        assert player.play()[0] in game.player_spots["red"]
+    assert game.player_spots == Game(["red", "black"], n=3).player_spots
+
+    simulator = Simulator(
+        BeamSearchPlayer, {**params, 'max_play_depth': 2, 'fanout': 2}, max_steps=6, n=2, seed=2,
+        opponent_classes=[SingleMoveProgressMaximizer] * 2, opponent_params=[{}] * 2,
+    )
+    simulator.execute(2)
+    assert simulator.results.n_games == 2
+
+
+def test_dataset_export(tmp_path):
+    hooks = DatasetExportHooks(str(tmp_path), chunk_size=40)
+    game = Game(["red", "black"], n=3)
+    players = {color: NonPlanningProgressMaximizer(color, game, {'max_depth': 2}) for color in game.player_spots}
+    start = GameState.from_game(game, "red")
+    win_sequence = game.run(30, players, hooks)
+    hooks.close()
+
+    dataset = Dataset(str(tmp_path))
+    assert len(dataset) == game.plies
+    assert [chunk['records'] for chunk in dataset.meta['chunks']] == [40] * (game.plies // 40) + [game.plies % 40] * (game.plies % 40 > 0)
+
+    # Records can be read one at a time, by slice or by any indices, across chunks
+    records = dataset[np.arange(len(dataset))]
+    assert records['ply'].tolist() == list(range(game.plies))
+    assert dataset[len(dataset) - 1] == records[-1]
+    assert np.array_equal(dataset[39:42], records[39:42])
+    with pytest.raises(IndexError):
+        dataset[len(dataset)]
+
+    # The planes start with the color to move, and the outcome is from its point of view
+    planes = dataset.planes(records[:2])
+    spot_index = game.board.spot_index
+    red = np.zeros(len(game.board.board_spots), dtype=bool)
+    red[[spot_index[spot] for spot in start.player_spots()["red"]]] = True
+    assert np.array_equal(planes[0, 0], red)
+    assert planes[0, 0, records[0]['start']] and not planes[0, :, records[0]['end']].any()
+    red[[records[0]['start'], records[0]['end']]] = [False, True]
+    assert np.array_equal(planes[1, 1], red)
+    for color_index, color in enumerate(["red", "black"]):
+        outcomes = records['outcome'][records['to_move'] == color_index]
+        assert np.all(outcomes == match_score(win_sequence, color))
+    assert len(dataset.sample(5, np.random.default_rng(0))) == 5
+
+
+def test_dataset_export_resumes(tmp_path):
+    path = str(tmp_path / "data")
+    checkpoint = str(tmp_path / "checkpoint.npz")
+
+    def interrupt(done, elapsed):
+        if done == 2:
+            raise KeyboardInterrupt
+
+    hooks = DatasetExportHooks(path, chunk_size=16)
+    interrupted = Simulator(SingleMoveProgressMaximizer, {}, max_steps=10, n=2, hooks=hooks)
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.execute(4, progress=interrupt, checkpoint=checkpoint, checkpoint_every=1)
+    hooks.close()
+    first = Dataset(path)
+    first_records = first[np.arange(len(first))]
+    assert set(first_records['game']) == {0, 1}
+
+    # The resumed run appends its chunks, and records the games under their ids in the simulation
+    hooks = DatasetExportHooks(path, chunk_size=16)
+    resumed = Simulator(SingleMoveProgressMaximizer, {}, max_steps=10, n=2, hooks=hooks)
+    resumed.execute(4, checkpoint=checkpoint)
+    hooks.close()
+    dataset = Dataset(path)
+    files = [chunk['file'] for chunk in dataset.meta['chunks']]
+    assert len(set(files)) == len(files) and files[:len(first.chunks)] == [chunk['file'] for chunk in first.meta['chunks']]
+    records = dataset[np.arange(len(dataset))]
+    assert np.array_equal(records[:len(first)], first_records)
+    assert set(records['game']) == {0, 1, 2, 3}
+
+    with pytest.raises(ValueError):
+        DatasetExportHooks(path).before_game(Game(["red", "black"], n=3))
+
+
+def test_first_moves():
+    for n, colors, depth, expected, result in perft.check_reference(perft.whole_position_plays, max_n=3):
+        assert result.nodes == expected
+
+    # The first moves of all the pieces at once are the moves get_legal_moves gives for each of them
+    board = Board(4)
+    rng = random.Random(1)
+    for large_board in (False, True):
+        game = Game(["red", "black", "green"], board=board, large_board=large_board)
+        spots = rng.sample(board.board_spots, 30)
+        game.player_spots = { "red": spots[:10], "black": spots[10:20], "green": spots[20:] }
+        first_moves = game.first_moves_by_piece("red")
+        for start, moves in zip(game.player_spots["red"], first_moves):
+            assert moves == game.get_legal_moves("red", start)
+
+        pieces, ends, move_states = game.first_moves("red")
+        assert len(pieces) == sum(map(len, first_moves))
+        assert np.all(np.diff(pieces) >= 0) and move_states.dtype == np.int8
+        assert [(board.board_spots[end], MoveState(move_state)) for end, move_state in zip(ends[pieces == 3], move_states[pieces == 3])] == first_moves[3]
+        subset, _, _ = game.first_moves("red", [2, 5])
+        assert set(subset.tolist()) <= {2, 5} and len(subset) == len(first_moves[2]) + len(first_moves[5])
+
+    # The players see the same moves as before
+    random.seed(3)
+    np.random.seed(3)
+    play = RandomSingleMovePlayer("red", game).play()
+    random.seed(3)
+    np.random.seed(3)
+    start = game.player_spots["red"][np.random.choice(game.pieces_per_player)]
+    legal_moves = game.get_legal_moves("red", start)
+    while True:
+        end, _ = random.choice(legal_moves)
+        if game.is_legal_endpoint("red", start, end):
+            break
+    assert play == [start, end]
+
+
+def test_parallel_simulation_is_deterministic():
+    serial = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=4)
+    serial.execute(4)
+    parallel = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=4)
+    parallel.execute(4, workers=2)
+    assert parallel.winners == serial.winners
+
+    # The hooks can not run in the workers, so they are not silently dropped
+    parallel.hooks = ProgressTrackerHooks(parallel.results)
+    with pytest.raises(ValueError):
+        parallel.execute(4, workers=2)
+
+    # A seed drawn for a run is not kept for the next one
+    unseeded = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2)
+    unseeded.execute(2, workers=2)
+    assert unseeded.seed is None and unseeded.results.n_games == 2
+
+
+def test_headless_simulation(tmp_path, monkeypatch):
+    # The engine must not need matplotlib
+    code = "import sys, simulate; sys.exit('matplotlib' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0
+
+    config = {
+        "player_class": "NonPlanningProgressMaximizer",
+        "player_params": {"max_depth": 2, "evaluator": {"progress": 1, "stragglers": 1}},
+        "n": 2,
+        "max_steps": 10,
+        "games": 3,
+        "workers": 2,
+        "seed": 1,
+        "output": str(tmp_path / "results.npz"),
+    }
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config, f)
+    simulator = simulate.main([str(tmp_path / "config.json"), "--quiet"])
+    results = ResultStore.load(str(tmp_path / "results.npz"))
+    assert results.winners() == simulator.winners
+    assert len(results.winners()) == 3
+
+    # The plays recorded before an interruption are still written to the dataset
+    play_game = Simulator.play_game
+
+    def interrupted_play_game(self, game_id, hooks=None):
+        if game_id == 2:
+            raise KeyboardInterrupt
+        return play_game(self, game_id, hooks)
+
+    monkeypatch.setattr(Simulator, "play_game", interrupted_play_game)
+    with pytest.raises(KeyboardInterrupt):
+        simulate.main([str(tmp_path / "config.json"), "--quiet", "--workers", "1", "--dataset", str(tmp_path / "data")])
+    dataset = Dataset(str(tmp_path / "data"))
+    assert len(dataset) > 0 and set(dataset[np.arange(len(dataset))]['game']) == {0, 1}
+
+
+def test_simulation_resumes_from_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.npz")
+
+    def interrupt(done, elapsed):
+        if done == 3:
+            raise KeyboardInterrupt
+
+    interrupted = Simulator(RandomPlayer, {"max_depth": 2}, max_steps=10, n=2)
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.execute(5, progress=interrupt, checkpoint=checkpoint, checkpoint_every=2)
+    assert ResultStore.load(checkpoint).n_games == 2
+    assert interrupted.games_left(5, checkpoint) == 3 and interrupted.games_left(5) == 5
+
+    # The seed is restored from the checkpoint, and only the missing games are played
+    with np.load(checkpoint) as data:
+        seed = int(data['seed'])
+    resumed = Simulator(RandomPlayer, {"max_depth": 2}, max_steps=10, n=2)
+    resumed.hooks = ProgressTrackerHooks(resumed.results)
+    resumed.execute(5, checkpoint=checkpoint)
+    assert interrupted.seed is None and resumed.seed is None
+    assert resumed.results.n_games == 5
+    with np.load(checkpoint) as data:
+        assert int(data['seed']) == seed
+
+    uninterrupted = Simulator(RandomPlayer, {"max_depth": 2}, max_steps=10, n=2, seed=seed)
+    uninterrupted.hooks = ProgressTrackerHooks(uninterrupted.results)
+    uninterrupted.execute(5)
+    assert resumed.winners == uninterrupted.winners
+
+    # The hooks keep writing to the restored results, under the ids of the games they track
+    assert resumed.hooks.store is resumed.results
+    progress = resumed.results.progress.data
+    assert set(progress['game']) == {2, 3, 4}
+    expected = uninterrupted.results.progress.data
+    assert np.array_equal(progress, expected[expected['game'] >= 2])
+
+
+def test_profiler(tmp_path):
+    for mode in ('trace', 'sample'):
+        profiler = SimulationProfiler(mode, games=2, interval=0.0005)
+        simulator = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=20, n=3, seed=1, profiler=profiler)
+        simulator.execute(4)
+        assert profiler.n_games == 2
+        phases = profiler.phases()
+        assert phases['legality'] > 0
+        assert abs(sum(phases.values()) - profiler.total) < 1e-9
+    assert len(profiler.stacks) > 10
+
+    # Stacks start inside the game, and every line is "phase;frame;frame... microseconds"
+    profiler.write_collapsed(str(tmp_path / "profile.folded"))
+    with open(tmp_path / "profile.folded") as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        phase, root = stack.split(";")[:2]
+        assert phase in PHASES and root == "game.py:Game.run" and int(count) > 0
+
+    # Time spent in hooks is attributed to them, including what they call
+    assert phase_of(("game.py:Game.run", "hooks.py:ProgressTrackerHooks.after_play", "players.py:Player.total_progress")) == 'hooks'
+    assert phase_of(("game.py:Game.run", "players.py:BaseProgressTracker.play", "players.py:DepthFirstMoveFinderMixin.explore", "game.py:Game.is_legal_move")) == 'legality'
+
+    # Workers send their stacks back
+    profiler = SimulationProfiler('trace', games=[0, 3])
+    simulator = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=1, profiler=profiler)
+    simulator.execute(4, workers=2)
+    assert profiler.n_games == 2 and profiler.total > 0
+
+
+def test_distributed_simulation():
+    from multiprocessing.connection import Client
+
+    serial = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=5)
+    serial.execute(10)
+
+    simulator = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=5)
+    coordinator = Coordinator(simulator, shard_size=3)
+
+    # A worker that takes a shard and goes away without playing it
+    def lost_worker():
+        connection = Client(coordinator.address, authkey=coordinator.authkey)
+        connection.recv()
+        assert connection.recv()[0] == 'shard'
+        connection.close()
+    thread = threading.Thread(target=lost_worker)
+    thread.start()
+    workers = start_workers(coordinator.address, coordinator.authkey, 2)
+    try:
+        coordinator.run(10)
+    finally:
+        coordinator.close()
+    thread.join()
+    for worker in workers:
+        worker.join(timeout=5)
+        assert worker.exitcode == 0
+
+    assert simulator.winners == serial.winners
+
+    # A seed drawn for the run is not kept on the simulator
+    unseeded = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2)
+    coordinator = Coordinator(unseeded)
+    workers = start_workers(coordinator.address, coordinator.authkey, 1)
+    try:
+        coordinator.run(2)
+    finally:
+        coordinator.close()
+    for worker in workers:
+        worker.join(timeout=5)
+    assert unseeded.seed is None and coordinator.worker_simulator.seed is not None
+    assert unseeded.results.n_games == 2
+
+
+class FirstBestPlayer(NonPlanningProgressMaximizer):
+    """Breaks ties by taking the smallest play, so that it plays the same everywhere"""
+    def choose_best(self, scores, plays):
+        rounded = np.round(scores, 2)
+        return min(plays[i] for i in np.flatnonzero(rounded == rounded.max()))
+
+
+def test_parallel_search():
+    game = Game(["red", "black"], n=3)
+    random.seed(0)
+    serial = {color: NonPlanningProgressMaximizer(color, game, {'max_depth': 3}) for color in game.player_spots}
+    with SearchPool(2) as pool:
+        parallel = {color: NonPlanningProgressMaximizer(color, game, {'max_depth': 3, 'search_pool': pool}) for color in game.player_spots}
+        for _ in range(4):
+            for color in game.player_spots:
+                serial_scores, serial_plays = serial[color].evaluate()
+                parallel_scores, parallel_plays = parallel[color].evaluate()
+                assert parallel_plays == serial_plays
+                assert np.array_equal(parallel_scores, serial_scores)
+                play = serial[color].choose_best(serial_scores, serial_plays)
+                game.push_move(color, play[0], play[-1], MoveState.ALREADY_CHECKED)
+        assert list(serial["red"].explored_positions) == list(parallel["red"].explored_positions)
+
+        # Planning, with opponents that play the same in the workers
+        params = {'max_depth': 2, 'max_play_depth': 2, 'fanout': 4}
+        planners = []
+        for search_pool in (None, pool):
+            planner = PlanningProgressMaximizer("red", game, {**params, 'search_pool': search_pool})
+            planner.opponent_models.append(FirstBestPlayer("black", game, {'max_depth': 2, 'position_memory': 0}))
+            planners.append(planner)
+        serial_scores, serial_plays = planners[0].evaluate()
+        parallel_scores, parallel_plays = planners[1].evaluate()
+        assert parallel_plays == serial_plays
+        assert np.allclose(parallel_scores, serial_scores)
+        assert pool.speculated == 4
+
+    # A pickled pool searches serially
+    unpickled = pickle.loads(pickle.dumps(pool))
+    finder = NonPlanningProgressMaximizer("red", game, {'max_depth': 2, 'search_pool': unpickled})
+    assert finder.evaluate()[1] == NonPlanningProgressMaximizer("red", game, {'max_depth': 2}).evaluate()[1]
+
+
+def test_opening_book(tmp_path):
+    simulator = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=15, n=2, seed=3)
+    book = build_book(simulator, 6, 4, str(tmp_path / "book.npy"), workers=2)
+    assert isinstance(book.entries, np.memmap)
+    assert np.all(np.diff(book.keys.astype(np.float64)) > 0)
+
+    # A seed drawn for building a book is not kept on the simulator
+    unseeded = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=15, n=2)
+    build_book(unseeded, 2, 2, str(tmp_path / "unseeded.npy"), workers=1)
+    assert unseeded.seed is None
+
+    # The first position is in every game, so the book has a play for it
+    game = Game(["red", "black"], n=2)
+    play = book.lookup(game, "red")
+    assert play is not None
+    assert game.is_legal_endpoint("red", play[0], play[-1])
+    assert 1 <= book.entry(GameState.from_game(game, "red").digest())['games'] <= 6
+    assert pickle.loads(pickle.dumps(book)).lookup(game, "red") == play
+
+    # Players play from the book until book_depth
+    player = NonPlanningProgressMaximizer("red", game, {'max_depth': 2, 'opening_book': book, 'book_depth': 1})
+    assert player.play() == play
+    game.plies = 1
+    assert player.book_play() is None
+
+    # Games with the book play the same openings as the games that built it
+    with_book = Simulator(
+        NonPlanningProgressMaximizer, {'max_depth': 2, 'opening_book': book, 'book_depth': 4},
+        max_steps=15, n=2, seed=3,
+    )
+    with_book.execute(2, workers=2)
+    assert len(with_book.winners) == 2
+
+
+def test_bot_server():
+    import urllib.request
+
+    httpd = make_server(("localhost", 0), allowed_origin="http://localhost:3000", workers=1, max_queue=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    url = "http://{}:{}".format(*httpd.server_address)
+
+    def request(method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read()), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read()), e.headers
+
+    try:
+        status, body, headers = request("POST", "/sessions", {
+            "player_class": "NonPlanningProgressMaximizer",
+            "player_params": {"max_depth": 2},
+            "colors": ["red", "black"],
+            "n": 2,
+            "color": "black",
+        })
+        assert status == 200 and headers["Access-Control-Allow-Origin"] == "http://localhost:3000"
+        session = "/sessions/" + body["session"]
+
+        # Only whitelisted classes and params are accepted, within their limits
+        for bad in (
+            {"player_class": "Game"},
+            {"player_class": "NonPlanningProgressMaximizer", "player_params": {"max_depth": 2, "opening_book": "/etc/passwd"}},
+            {"player_class": "NonPlanningProgressMaximizer", "player_params": {"max_depth": 1000}},
+            {"player_class": "BeamSearchPlayer", "player_params": {"max_depth": 2, "max_play_depth": 2, "fanout": 10 ** 6}},
+            {"player_class": "PlanningProgressMaximizer", "player_params": {"max_depth": 2, "max_play_depth": 1, "cheap_opponent_class": "Simulator"}},
+            {"player_class": "NonPlanningProgressMaximizer", "player_params": {"max_depth": 2}, "n": 1000},
+            {"player_class": "NonPlanningProgressMaximizer", "player_params": {"max_depth": 2}, "colors": ["red", "purple"]},
+            {"player_class": "NonPlanningProgressMaximizer", "player_params": {}},
+        ):
+            assert request("POST", "/sessions", bad)[0] == 400
+
+        # An illegal move is rejected and leaves the position as it was
+        game = httpd.bots.sessions[body["session"]].game
+        before = game.position()
+        status, body, _ = request("POST", session + "/moves", {"moves": [{"color": "red", "play": [[0, 0, 0], [5, 5, 10]]}]})
+        assert status == 400 and game.position() == before
+
+        red = NonPlanningProgressMaximizer("red", Game(["red", "black"], n=2), {'max_depth': 2})
+        red_play = min(play for _, play in red.moves())
+        status, _, _ = request("POST", session + "/moves", {"moves": [{"color": "red", "play": [list(spot) for spot in red_play]}]})
+        assert status == 200 and game.plies == 1
+
+        status, body, _ = request("POST", session + "/play", {"seconds": 5})
+        assert status == 200
+        play = [tuple(spot) for spot in body["play"]]
+        assert play[-1] in game.player_spots["black"] and game.plies == 2
+
+        status, body, _ = request("GET", "/metrics")
+        assert body["endpoints"]["play"]["count"] == 1 and body["endpoints"]["moves"]["errors"] == 1
+        assert request("POST", session + "/play", {"seconds": 10 ** 6})[0] == 400
+
+        # Malformed bodies are rejected, and a list of moves is applied entirely or not at all
+        for path, method, bad in (
+            ("/moves", "POST", {"moves": [1]}),
+            ("/moves", "POST", {"moves": [{"color": ["red"], "play": [[0, 0, 0], [0, 0, 0]]}]}),
+            ("/position", "PUT", {"player_spots": {"red": 5, "black": 5}}),
+            ("/position", "PUT", {"player_spots": {color: [list(spot) for spot in spots] for color, spots in game.player_spots.items()}, "plies": "3"}),
+        ):
+            assert request(method, session + path, bad)[0] == 400
+        before, plies = game.position(), game.plies
+        red_play = min(play for _, play in NonPlanningProgressMaximizer("red", game, {'max_depth': 2}).moves())
+        status, _, _ = request("POST", session + "/moves", {"moves": [
+            {"color": "red", "play": [list(spot) for spot in red_play]},
+            {"color": "black", "play": [[0, 0, 0], [5, 5, 10]]},
+        ]})
+        assert status == 400 and game.position() == before and game.plies == plies
+        assert request("GET", "/sessions/nope/play")[0] == 404
+        assert request("DELETE", session)[0] == 200
+        assert request("POST", session + "/play", {})[0] == 404
+    finally:
+        httpd.shutdown()
+        httpd.bots.close()
+        httpd.server_close()
+
+    # Without a configured origin, browsers are not allowed to call the server
+    httpd = make_server(("localhost", 0), workers=1)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    url = "http://{}:{}".format(*httpd.server_address)
+    try:
+        status, _, headers = request("GET", "/metrics")
+        assert status == 200 and "Access-Control-Allow-Origin" not in headers
+    finally:
+        httpd.shutdown()
+        httpd.bots.close()
+        httpd.server_close()
+
+    # With every worker busy and no queue, requests are turned away
+    bots = BotServer(workers=1, max_queue=0)
+    started, release = threading.Event(), threading.Event()
+    busy = threading.Thread(target=bots.submit, args=(lambda: (started.set(), release.wait()),))
+    busy.start()
+    started.wait()
+    with pytest.raises(HttpError) as e:
+        bots.submit(lambda: None)
+    assert e.value.status == 503
+    release.set()
+    busy.join()
+    assert bots.submit(lambda: 1) == 1
+
+    # Unexpected errors are answered with a 500, and counted
+    bots.route = lambda method, path, body: ('broken', lambda: 1 / 0)
+    assert bots.handle("GET", "/broken", {})[0] == 500
+    assert bots.metrics_summary()['endpoints']['broken']['errors'] == 1
+    bots.close()
+
+
+class SlowRemotePlayer(NonPlanningProgressMaximizer):
+    """Waits for a while before every play, like a human or a bot on another machine"""
+    waiting = 0
+    max_waiting = 0
+
+    async def play(self):
+        SlowRemotePlayer.waiting += 1
+        SlowRemotePlayer.max_waiting = max(SlowRemotePlayer.max_waiting, SlowRemotePlayer.waiting)
+        await asyncio.sleep(0.01)
+        SlowRemotePlayer.waiting -= 1
+        return super().play()
+
+
+class AsyncCountingHooks(GameHooks):
+    def __init__(self):
+        self.plays = 0
+
+    async def after_play(self, color, player, moves):
+        await asyncio.sleep(0)
+        self.plays += 1
+
+
+def test_async_simulation():
+    # A single game plays the same with run_async as with run
+    serial = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=7)
+    serial.execute(1)
+    concurrent = Simulator(NonPlanningProgressMaximizer, {'max_depth': 2}, max_steps=10, n=2, seed=7)
+    asyncio.run(concurrent.execute_async(1))
+    assert concurrent.winners == serial.winners
+
+    # Games that wait for their players run at the same time, up to the concurrency
+    hooks = AsyncCountingHooks()
+    simulator = Simulator(SlowRemotePlayer, {'max_depth': 1}, max_steps=5, n=2, hooks=hooks, seed=1)
+    done = []
+    asyncio.run(simulator.execute_async(12, concurrency=4, progress=lambda n, elapsed: done.append(n)))
+    assert SlowRemotePlayer.max_waiting == 4
+    assert done == list(range(1, 13))
+    assert len(simulator.winners) == 12
+    assert hooks.plays == sum(min(step + 1, 5) for winners in simulator.winners for _, step in winners)
@@ -0,0 +1,71 @@
+from collections import defaultdict
+import math
+import time
+
+
+class Deadline(object):
+    """The point in time by which a player should have decided on its play.
+    A deadline without a number of seconds never expires.
+    """
+    def __init__(self, seconds=None):
+        self.start = time.perf_counter()
+        self.end = None if seconds is None else self.start + seconds
+
+    def expired(self):
+        return self.end is not None and time.perf_counter() >= self.end
+
+    def remaining(self):
+        if self.end is None:
+            return math.inf
+        return max(self.end - time.perf_counter(), 0.0)
+
+
+# Used when there is no time control
+NO_DEADLINE = Deadline()
+
+
+class TimeControl(object):
+    """Time budgets for each play and for all the plays of a color in a game, in seconds.
+    Also records how long the plays took and how often they went more than grace seconds over their deadline.
+    """
+    def __init__(self, per_play=None, per_game=None, grace=0.0):
+        self.per_play = per_play
+        self.per_game = per_game
+        self.grace = grace
+        self.plays = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.max_seconds = defaultdict(float)
+        self.overruns = defaultdict(int)
+        self.clocks = {}
+
+    def start_game(self, colors):
+        self.clocks = { color: self.per_game for color in colors }
+
+    def start_play(self, color):
+        """Returns the deadline for the color's next play"""
+        budgets = [budget for budget in (self.per_play, self.clocks.get(color)) if budget is not None]
+        self.deadline = Deadline(min(budgets) if budgets else None)
+        return self.deadline
+
+    def end_play(self, color):
+        now = time.perf_counter()
+        elapsed = now - self.deadline.start
+        self.plays[color] += 1
+        self.seconds[color] += elapsed
+        self.max_seconds[color] = max(self.max_seconds[color], elapsed)
+        if self.deadline.end is not None and now > self.deadline.end + self.grace:
+            self.overruns[color] += 1
+        if self.clocks.get(color) is not None:
+            self.clocks[color] = max(self.clocks[color] - elapsed, 0.0)
+
+    def stats(self):
+        """Returns the number of plays, plays per second, the slowest play and the overruns for each color"""
+        return {
+            color: {
+                'plays': plays,
+                'plays_per_second': plays / self.seconds[color] if self.seconds[color] else math.inf,
+                'max_seconds': self.max_seconds[color],
+                'overruns': self.overruns[color],
+            }
+            for color, plays in self.plays.items()
+        }
@@ -0,0 +1,200 @@
+from collections import defaultdict
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import time
+
+from hooks import GameHooks
+from results import match_score
+from simulator import Simulator
+
+
+class ParameterSpace(object):
+    """The ranges of the player params being tuned.
+    Each range is a (low, high) pair, and the param is an integer if both ends are integers.
+    """
+    def __init__(self, **ranges):
+        self.ranges = ranges
+
+    def sample(self, rng):
+        params = {}
+        for name, (low, high) in self.ranges.items():
+            if isinstance(low, int) and isinstance(high, int):
+                params[name] = rng.randint(low, high)
+            else:
+                params[name] = rng.uniform(low, high)
+        return params
+
+
+class CpuTimeHooks(GameHooks):
+    """Measures the CPU time each color spends deciding on its plays"""
+    def __init__(self):
+        self.cpu = defaultdict(float)
+        self.plays = defaultdict(int)
+
+    def before_play(self, color, player):
+        self.start = time.process_time()
+
+    def after_play(self, color, player, moves):
+        self.cpu[color] += time.process_time() - self.start
+        self.plays[color] += 1
+
+
+def strength_for_cpu(strength, cpu_per_play, cpu_weight=0.05, min_cpu=1e-3):
+    """Strength minus cpu_weight times the log of the CPU seconds per play, so each halving of the cost is worth a fixed bit of strength"""
+    return strength - cpu_weight * math.log(max(cpu_per_play, min_cpu))
+
+
+def play_match(args):
+    """Plays one game between a candidate and the baseline. Runs in the worker processes."""
+    simulator, game_id, color = args
+    hooks = CpuTimeHooks()
+    win_sequence = simulator.play_game(game_id, hooks.compile())
+    return match_score(win_sequence, color), hooks.cpu[color], hooks.plays[color], sum(hooks.cpu.values())
+
+
+class SuccessiveHalving(object):
+    """Tunes a player's params with successive halving over parallel self-play matches.
+
+    n_candidates param sets are sampled from the space. In each rung, every remaining candidate
+    plays games against the baseline params until the games have used cpu_budget seconds of CPU,
+    and the best 1/eta of the candidates by objective(strength, cpu_per_play) go on to the next rung,
+    which has eta times the budget. By default the objective is strength_for_cpu,
+    where strength is the fraction of games won against the baseline.
+
+    If a checkpoint path is given, the search state is saved there after every candidate,
+    and a search that is run again with the same checkpoint resumes where it stopped.
+    """
+    def __init__(
+        self,
+        player_class,
+        space,
+        baseline_params,
+        fixed_params=None,
+        n_candidates=16,
+        eta=2,
+        cpu_budget=10.0,
+        workers=None,
+        n=4,
+        max_steps=100,
+        player_colors=("red", "black"),
+        seed=0,
+        checkpoint=None,
+        objective=strength_for_cpu,
+    ):
+        self.player_class = player_class
+        self.space = space
+        self.baseline_params = baseline_params
+        self.fixed_params = fixed_params if fixed_params else {}
+        self.n_candidates = n_candidates
+        self.eta = eta
+        self.cpu_budget = cpu_budget
+        self.workers = workers if workers else os.cpu_count()
+        self.n = n
+        self.max_steps = max_steps
+        self.player_colors = player_colors
+        self.seed = seed
+        self.checkpoint = checkpoint
+        self.objective = objective
+
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, 'rb') as f:
+                self.state = pickle.load(f)
+        else:
+            rng = random.Random(seed)
+            self.state = {
+                'rung': 0,
+                'next_game': 0,
+                'remaining': list(range(n_candidates)),
+                'evaluated': [],
+                'candidates': [
+                    { **self.fixed_params, **space.sample(rng) }
+                    for _ in range(n_candidates)
+                ],
+                'stats': [
+                    { 'games': 0, 'score': 0.0, 'cpu': 0.0, 'plays': 0 }
+                    for _ in range(n_candidates)
+                ],
+            }
+
+    def save(self):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.state, f)
+        os.replace(tmp, self.checkpoint)
+
+    def fitness(self, i):
+        stats = self.state['stats'][i]
+        if stats['games'] == 0:
+            return -math.inf
+        return self.objective(stats['score'] / stats['games'], stats['cpu'] / max(stats['plays'], 1))
+
+    def evaluate(self, i, budget, pool):
+        """Plays games between candidate i and the baseline until they have used the CPU budget"""
+        stats = self.state['stats'][i]
+        cpu_used = 0.0
+        while True:
+            matches = []
+            for _ in range(self.workers):
+                game_id = self.state['next_game']
+                self.state['next_game'] += 1
+
+                # Let the candidate play every color in turn
+                color = self.player_colors[game_id % len(self.player_colors)]
+                simulator = Simulator(
+                    self.player_class,
+                    { **self.fixed_params, **self.baseline_params },
+                    max_steps=self.max_steps,
+                    n=self.n,
+                    player_colors=self.player_colors,
+                    color_params={ color: self.state['candidates'][i] },
+                    seed=self.seed,
+                )
+                matches.append((simulator, game_id, color))
+
+            for score, cpu, plays, total_cpu in pool.imap_unordered(play_match, matches):
+                stats['games'] += 1
+                stats['score'] += score
+                stats['cpu'] += cpu
+                stats['plays'] += plays
+                cpu_used += total_cpu
+            if cpu_used >= budget:
+                break
+
+    def run(self):
+        """Runs the search to the end and returns the best params"""
+        state = self.state
+        with multiprocessing.Pool(self.workers) as pool:
+            while len(state['remaining']) > 1:
+                budget = self.cpu_budget * self.eta ** state['rung']
+                for i in state['remaining']:
+                    if i in state['evaluated']:
+                        continue
+                    self.evaluate(i, budget, pool)
+                    state['evaluated'].append(i)
+                    self.save()
+
+                # Keep the best candidates for the next rung
+                ranked = sorted(state['remaining'], key=self.fitness, reverse=True)
+                state['remaining'] = ranked[:max(1, math.ceil(len(ranked) / self.eta))]
+                state['evaluated'] = []
+                state['rung'] += 1
+                self.save()
+        return self.best()
+
+    def best(self):
+        best = max(self.state['remaining'], key=self.fitness)
+        return self.state['candidates'][best]
+
+    def results(self):
+        """Returns (params, strength, cpu per play, fitness) for every candidate, best first"""
+        rows = []
+        for i, params in enumerate(self.state['candidates']):
+            stats = self.state['stats'][i]
+            games = max(stats['games'], 1)
+            rows.append((params, stats['score'] / games, stats['cpu'] / max(stats['plays'], 1), self.fitness(i)))
+        return sorted(rows, key=lambda row: row[-1], reverse=True)